@@ -0,0 +1,99 @@
+import logging
+from collections import Counter
+from sqlalchemy import select, func
+from telethon import TelegramClient
+from telethon.tl import types
+from telethon.tl.functions.channels import JoinChannelRequest
+from models import Session, Source
+from routing import peer_id
+from retry import retry_call
+from logs import fields
+
+logger = logging.getLogger(__name__)
+
+# 多账号接收：每个来源由一个用户账号接收消息（Source.account，为空时是主账号），
+# 新绑定的来源分配给负责来源最少的账号，分散每个账号的频道数量和更新流量。
+# 所有账号的事件进入同一个转发流程，由消息去重过滤多个账号收到的同一条消息。
+
+class Account:
+    def __init__(self, name, client):
+        self.name = name  # 会话名称，对应 sessions/<name>.session
+        self.client = client
+        self.active = False  # 已登录并在接收消息
+
+class AccountPool:
+    def __init__(self, names, api_id, api_hash):
+        self.accounts = {
+            name: Account(name, TelegramClient(
+                f'sessions/{name}',
+                api_id,
+                api_hash,
+                connection_retries=None,  # 无限重试
+                retry_delay=1
+            ))
+            for name in names
+        }
+        self.primary = next(iter(self.accounts.values()))  # 第一个账号，也用于命令中的聊天信息查询
+        self.owners = {}  # 来源真实ID -> 接收账号名称
+
+    def __len__(self):
+        return len(self.accounts)
+
+    def __iter__(self):
+        return iter(self.accounts.values())
+
+    def active(self):
+        return [account for account in self if account.active]
+
+    async def load(self):
+        """从数据库加载每个来源的接收账号"""
+        async with Session() as session:
+            rows = await session.execute(
+                select(Source.chat_id, func.max(Source.account)).group_by(Source.chat_id)
+            )
+            self.owners = {chat_id: account or self.primary.name for chat_id, account in rows}
+
+    def loads(self):
+        """每个账号负责的来源数"""
+        counts = Counter(self.owners.values())
+        return {account.name: counts[account.name] for account in self}
+
+    def by_load(self):
+        """已登录的账号，按负责的来源数从少到多排列"""
+        loads = self.loads()
+        return sorted(self.active(), key=lambda account: loads[account.name])
+
+    def owner(self, chat_id):
+        """来源的接收账号，未绑定或账号已不在配置中时返回 None"""
+        return self.accounts.get(self.owners.get(chat_id))
+
+    def receiver(self, chat_id):
+        """当前接收来源消息的账号：接收账号不可用时为主账号"""
+        account = self.owner(chat_id)
+        if account is None or not account.active:
+            return self.primary
+        return account
+
+    def assign(self, chat_id, account):
+        self.owners[chat_id] = account.name
+
+    def retain(self, chat_ids):
+        """解绑后只保留仍有绑定的来源"""
+        self.owners = {chat_id: name for chat_id, name in self.owners.items() if chat_id in chat_ids}
+
+    def owns(self, client, chat_id):
+        """事件是否应由这个客户端处理：来源的接收账号不可用时任何账号都可以处理，重复的消息由去重过滤"""
+        account = self.owner(peer_id(chat_id))
+        return account is None or not account.active or account.client is client
+
+    async def subscribe(self, account, source):
+        """确保账号能收到来源的消息：无法访问时返回 False，公开频道或超级群组未加入时先加入"""
+        try:
+            entity = await retry_call(account.client.get_entity, source, name='get_entity')
+            if isinstance(entity, types.Channel) and entity.left:
+                await retry_call(account.client, JoinChannelRequest(entity), name='join_channel')
+                logger.info("账号已加入来源", extra=fields(account=account.name, source=entity.id))
+            return True
+        except Exception as e:
+            logger.warning(f"账号无法接收来源: {str(e)}", extra=fields(account=account.name, source=source))
+            return False
@@ -0,0 +1,307 @@
+"""离线性能测试：不连接 Telegram，用模拟的事件、客户端和 Bot 驱动 handle_new_message
+
+示例：
+    python benchmark.py                                  # 运行全部预设场景
+    python benchmark.py --scenario fanout --rate 500     # 指定场景和注入速率
+    python benchmark.py --sources 20 --targets 3 --keywords 500 --regex 5 --latency 50
+    python benchmark.py --scenario keywords --latency 0 --shards 4   # 分片模式
+"""
+import argparse
+import asyncio
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+# 预设场景：来源数、每个来源的目标数、每个目标的关键字数、每个来源的正则规则数
+SCENARIOS = {
+    'baseline': dict(sources=1, targets=1, keywords=0, regex=0),
+    'fanout': dict(sources=1, targets=20, keywords=10, regex=0),
+    'many_sources': dict(sources=100, targets=2, keywords=10, regex=0),
+    'keywords': dict(sources=10, targets=2, keywords=2000, regex=0),
+    'regex': dict(sources=10, targets=2, keywords=10, regex=10),
+}
+
+VOCABULARY = [f'word{i}' for i in range(500)]
+REGEX_PATTERNS = [r'AD\d+', r'https?://\S+', r'@\w+', r'#tag\d+', r'\s{2,}', r'【[^】]*】', r'\(via [^)]*\)', r'[!?]{3,}']
+
+SOURCE_BASE = 1500000000  # 来源的真实ID从这里开始
+TARGET_BASE = -1002500000000  # 目标的 Bot API ID 从这里向下递减
+
+def setup_environment(workdir):
+    """导入 main 之前设置环境变量，所有数据写入临时目录，不影响正式数据"""
+    for name, value in [('API_ID', '1'), ('API_HASH', 'benchmark'), ('BOT_TOKEN', '1:benchmark'), ('USER_ID', '1')]:
+        os.environ.setdefault(name, value)
+    os.environ.update({
+        'DATABASE_URL': f'sqlite:///{workdir}/benchmark.db',
+        'OUTBOX_PATH': f'{workdir}/outbox.db',
+        'MESSAGE_MAP_PATH': f'{workdir}/message_map.db',
+        'ENTITY_CACHE_PATH': f'{workdir}/entities.json',
+        'DEDUP_PATH': '',
+    })
+    # main 在导入时创建 sessions 目录和 Telethon 会话文件
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)
+
+class StubBot:
+    """记录发送请求的 Bot，每次调用按设定的延迟等待"""
+    def __init__(self, latency=0.0, jitter=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.next_id = 1
+        self.on_send = None
+
+    async def _call(self, kwargs):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        self.next_id += 1
+        if self.on_send is not None:
+            self.on_send(kwargs)
+        return SimpleNamespace(message_id=self.next_id)
+
+    async def send_message(self, **kwargs):
+        return await self._call(kwargs)
+
+    async def edit_message_text(self, **kwargs):
+        return await self._call(kwargs)
+
+    async def delete_message(self, **kwargs):
+        return await self._call(kwargs)
+
+class FakeChat:
+    def __init__(self, chat_id):
+        self.id = chat_id
+        self.title = f'source {chat_id}'
+        self.broadcast = True
+
+class FakeClient:
+    """模拟 Telethon 客户端的聊天信息解析"""
+    def __init__(self):
+        self.chats = {}
+        self.lookups = 0
+
+    async def get_entity(self, chat_id):
+        self.lookups += 1
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = FakeChat(chat_id)
+        return chat
+
+class FakeMessage:
+    def __init__(self, chat_id, message_id, text):
+        self.chat_id = chat_id
+        self.id = message_id
+        self.text = text
+        self.grouped_id = None
+        self.photo = None
+        self.document = None
+        self.action = None
+
+class FakeEvent:
+    """模拟 NewMessage 事件，提供转发流程用到的属性"""
+    def __init__(self, client, source_id, message_id, text):
+        self._client = client
+        self._source_id = source_id
+        self.chat_id = int(f'-100{source_id}')
+        self.message = FakeMessage(self.chat_id, message_id, text)
+        self.is_channel = True
+
+    async def get_chat(self):
+        return await self._client.get_entity(self._source_id)
+
+def make_text(seq, keyword_hit):
+    """消息文本开头是序号，用于计算端到端延迟；部分消息带有会被正则删除的内容"""
+    words = random.choices(VOCABULARY, k=random.randint(5, 40))
+    if keyword_hit:
+        words.append(keyword_hit)
+    if random.random() < 0.3:
+        words.append(f'AD{random.randint(1, 999)} https://example.com/{seq}')
+    return f'#{seq} ' + ' '.join(words)
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+async def configure(main, models, sources, targets, keywords, regex):
+    """清空数据库并写入场景的绑定、关键字和正则规则"""
+    from sqlalchemy import delete
+    async with models.write_session() as session:
+        for model in (models.Source, models.Keyword, models.RegexFormat):
+            await session.execute(delete(model))
+        for s in range(sources):
+            source_id = SOURCE_BASE + s
+            for t in range(targets):
+                target_id = TARGET_BASE - s * targets - t
+                # 黑名单模式，关键字大部分不会出现在消息中，匹配器需要完整扫描
+                session.add(models.Source(chat_id=source_id, target_chat_id=target_id, chat_type='channel', filter_mode='blacklist'))
+                session.add_all(models.Keyword(target_chat_id=target_id, word=f'kw{target_id}x{k}') for k in range(keywords))
+            session.add_all(
+                models.RegexFormat(chat_id=source_id, pattern=REGEX_PATTERNS[r % len(REGEX_PATTERNS)], parse_mode='html', position=r)
+                for r in range(regex)
+            )
+    await main.routing_table.load()
+    if main.shard_pool is not None:
+        # 工作进程重新加载完再开始计时
+        main.shard_pool.reload()
+        await main.shard_pool.wait_ready()
+
+def idle(main):
+    """来源队列、发送调度器和发送任务都已处理完"""
+    return (
+        not main.source_queues.depths()
+        and not main.source_queues.busy
+        and not main.send_scheduler.busy
+        and not main.background_tasks
+    )
+
+async def run_scenario(main, models, name, sources, targets, keywords, regex, messages, rate, hit_ratio, trace_memory):
+    await configure(main, models, sources, targets, keywords, regex)
+    main.message_dedup = main.DedupWindow(window=600)
+    client = main.client
+    bot = main.application.bot
+
+    injected = {}  # 序号 -> 注入时间
+    latencies = []
+    def on_send(kwargs):
+        seq = int(kwargs['text'].split(' ', 1)[0][1:])
+        latencies.append(time.perf_counter() - injected[seq])
+    bot.on_send = on_send
+
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    interval = 1 / rate if rate else 0
+    for seq in range(messages):
+        source_id = SOURCE_BASE + seq % sources
+        hit = f'kw{TARGET_BASE - (seq % sources) * targets}x0' if keywords and random.random() < hit_ratio else None
+        event = FakeEvent(client, source_id, seq + 1, make_text(seq, hit))
+        injected[seq] = time.perf_counter()
+        await main.handle_new_message(event)
+        if interval:
+            # 按目标速率注入，落后时不等待
+            delay = started + (seq + 1) * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif seq % 100 == 0:
+            await asyncio.sleep(0)
+    while not idle(main):
+        await asyncio.sleep(0.005)
+    elapsed = time.perf_counter() - started
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        'scenario': name,
+        'messages': messages,
+        'sends': len(latencies),
+        'msgs_per_sec': messages / elapsed,
+        'sends_per_sec': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'peak_mb': peak / 1024 / 1024 if peak is not None else None,
+        'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+def print_header():
+    print(f"{'scenario':<14}{'msgs':>8}{'sends':>9}{'msgs/s':>10}{'sends/s':>10}{'p50 ms':>9}{'p99 ms':>9}{'peak MB':>9}{'RSS MB':>9}")
+
+def print_row(r):
+    peak = f"{r['peak_mb']:.1f}" if r['peak_mb'] is not None else '-'
+    print(
+        f"{r['scenario']:<14}{r['messages']:>8}{r['sends']:>9}{r['msgs_per_sec']:>10.0f}{r['sends_per_sec']:>10.0f}"
+        f"{r['p50_ms']:>9.1f}{r['p99_ms']:>9.1f}{peak:>9}{r['rss_mb']:>9.1f}"
+    )
+
+async def run(args):
+    import main
+    import models
+    from logs import setup_logging
+    from sender import SendScheduler
+
+    # 转发流程中的日志不输出，但格式化和写入仍计入耗时
+    devnull = open(os.devnull, 'w')
+    log_listener = setup_logging(devnull)
+
+    bot = StubBot(latency=args.latency / 1000, jitter=args.jitter / 1000)
+    main.application = SimpleNamespace(bot=bot)
+    main.client = FakeClient()
+    if not args.rate_limits:
+        # 默认不限速，测量转发流程本身的吞吐量
+        main.send_scheduler = SendScheduler(workers=main.FORWARD_CONCURRENCY, global_rate=1e9, chat_rate=1e9, group_rate=1e12)
+
+    if args.sources:
+        scenarios = {'custom': dict(sources=args.sources, targets=args.targets, keywords=args.keywords, regex=args.regex)}
+    else:
+        names = args.scenario or list(SCENARIOS)
+        scenarios = {name: SCENARIOS[name] for name in names}
+
+    await models.init_db()
+    main.outbox.open()
+    main.message_map.open()
+    main.send_scheduler.start(bot)
+    main.source_queues.start()
+    if main.shard_pool is not None:
+        await main.shard_pool.start()
+    results = []
+    print_header()
+    try:
+        for name, params in scenarios.items():
+            result = await run_scenario(
+                main, models, name, messages=args.messages, rate=args.rate,
+                hit_ratio=args.hit_ratio, trace_memory=args.tracemalloc, **params
+            )
+            results.append(result)
+            print_row(result)
+    finally:
+        await main.source_queues.stop()
+        if main.shard_pool is not None:
+            await main.shard_pool.stop()
+        await main.send_scheduler.stop()
+        await main.outbox.close()
+        await main.message_map.close()
+        await models.engine.dispose()
+        log_listener.stop()
+        devnull.close()
+    return results
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='离线转发性能测试')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS), help='要运行的预设场景，可重复指定，默认全部')
+    parser.add_argument('--sources', type=int, default=0, help='自定义场景的来源数（指定后忽略 --scenario）')
+    parser.add_argument('--targets', type=int, default=1, help='自定义场景每个来源的目标数')
+    parser.add_argument('--keywords', type=int, default=0, help='自定义场景每个目标的关键字数')
+    parser.add_argument('--regex', type=int, default=0, help='自定义场景每个来源的正则规则数')
+    parser.add_argument('--messages', type=int, default=2000, help='每个场景注入的消息数')
+    parser.add_argument('--rate', type=float, default=0, help='注入速率（条/秒），0 为尽快注入')
+    parser.add_argument('--latency', type=float, default=20, help='模拟 Bot API 调用的延迟（毫秒）')
+    parser.add_argument('--jitter', type=float, default=10, help='延迟的随机抖动上限（毫秒）')
+    parser.add_argument('--hit-ratio', type=float, default=0.1, help='命中黑名单关键字（被过滤）的消息比例')
+    parser.add_argument('--rate-limits', action='store_true', help='使用 .env 中配置的出站限速')
+    parser.add_argument('--tracemalloc', action='store_true', help='统计每个场景的峰值内存分配（会降低吞吐量）')
+    parser.add_argument('--shards', type=int, default=0, help='分片工作进程数，0 为单进程')
+    parser.add_argument('--seed', type=int, default=1, help='随机数种子')
+    return parser.parse_args(argv)
+
+def main_cli(argv=None):
+    args = parse_args(argv)
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory(prefix='forwarder-bench-') as workdir:
+        cwd = os.getcwd()
+        setup_environment(workdir)
+        os.environ['SHARDS'] = str(args.shards)
+        try:
+            asyncio.run(run(args))
+        finally:
+            os.chdir(cwd)
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+from sqlalchemy import select, update, func, or_
+from telethon.tl.types import PeerChannel, PeerChat, PeerUser
+from models import Session, Source, write_session
+from logs import fields
+
+logger = logging.getLogger(__name__)
+
+# 停机补发：记录每个来源最后处理的消息ID，启动时从这里开始拉取历史消息，
+# 交给和实时消息相同的转发流程
+
+class Checkpoints:
+    """每个来源最后处理的消息ID，先记录在内存中，定期批量写入数据库"""
+    def __init__(self):
+        self.pending = {}  # 来源真实ID -> 消息ID
+
+    def mark(self, chat_id, message_id):
+        if message_id > self.pending.get(chat_id, 0):
+            self.pending[chat_id] = message_id
+
+    async def load(self):
+        """返回已有记录的来源 {来源真实ID: (聊天类型, 最后处理的消息ID)}"""
+        async with Session() as session:
+            rows = await session.execute(
+                select(Source.chat_id, func.min(Source.chat_type), func.max(Source.last_message_id))
+                .where(Source.last_message_id.is_not(None))
+                .group_by(Source.chat_id)
+            )
+            return {chat_id: (chat_type, last_message_id) for chat_id, chat_type, last_message_id in rows}
+
+    async def save(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        try:
+            async with write_session() as session:
+                for chat_id, message_id in pending.items():
+                    # 只向前推进，同一来源的所有绑定共用一个位置
+                    await session.execute(
+                        update(Source)
+                        .where(
+                            Source.chat_id == chat_id,
+                            or_(Source.last_message_id.is_(None), Source.last_message_id < message_id)
+                        )
+                        .values(last_message_id=message_id)
+                    )
+        except Exception as e:
+            logger.error(f"保存补发位置失败: {str(e)}")
+            for chat_id, message_id in pending.items():
+                self.mark(chat_id, message_id)
+
+    async def autosave(self, interval=5):
+        while True:
+            await asyncio.sleep(interval)
+            await self.save()
+
+PEER_TYPES = {
+    'channel': PeerChannel,
+    'group': PeerChannel,
+    'chat': PeerChat,
+    'private': PeerUser,
+}
+
+async def input_peer(client, chat_id, chat_type):
+    """绑定时保存的是不带前缀的真实ID，按聊天类型还原为 Telethon 可以解析的 Peer
+
+    类型未知时不猜测，从会话缓存中按ID查找（用户、普通群组、频道都会匹配），找不到时抛出 ValueError。
+    """
+    peer_type = PEER_TYPES.get(chat_type)
+    if peer_type is not None:
+        return peer_type(chat_id)
+    return await client.get_input_entity(chat_id)
+
+async def fetch_missed(client, peer, min_id, limit):
+    """获取 min_id 之后的消息，按时间顺序返回，超过 limit 条时只保留最新的"""
+    # iter_messages 每次请求取一批（接口上限 100 条），从新到旧分页
+    messages = [message async for message in client.iter_messages(peer, min_id=min_id, limit=limit)]
+    messages.reverse()
+    return messages
+
+async def catch_up(client, checkpoints, feed, limit=1000, concurrency=4):
+    """并发补发各来源停机期间的消息，同时进行的来源数不超过 concurrency
+
+    feed(chat_id, messages) 负责把消息交给转发流程，获取失败时 messages 为空列表。
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(chat_id, chat_type, last_message_id):
+        async with semaphore:
+            messages = []
+            try:
+                messages = await fetch_missed(client, await input_peer(client, chat_id, chat_type), last_message_id, limit)
+                if messages:
+                    skipped = '，已达到上限，更早的消息不再补发' if len(messages) >= limit else ''
+                    logger.info(f"补发 {len(messages)} 条消息{skipped}", extra=fields(source=chat_id))
+            except Exception as e:
+                logger.error(f"获取历史消息失败: {str(e)}", extra=fields(source=chat_id))
+            await feed(chat_id, messages)
+
+    await asyncio.gather(*(
+        run(chat_id, chat_type, last_message_id)
+        for chat_id, (chat_type, last_message_id) in checkpoints.items()
+    ))
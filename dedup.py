@@ -0,0 +1,90 @@
+import asyncio
+import json
+import os
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+class DedupWindow:
+    """按时间窗口去重
+
+    键为整数元组，如 (chat_id, message_id)。窗口长度固定，先加入的键一定先过期，
+    dict 的插入顺序就是过期顺序，每次只需从头部清理，均摊 O(1)。
+    可选保存到磁盘，重启后不会重复转发窗口内已处理的消息。
+    """
+    def __init__(self, window=600, path=None):
+        self.window = window
+        self.path = path
+        self.expires = {}  # 键 -> 过期时间，按插入顺序排列
+        self._dirty = False
+
+    def __len__(self):
+        return len(self.expires)
+
+    def _expire(self, now):
+        expires = self.expires
+        while expires:
+            key = next(iter(expires))
+            if expires[key] > now:
+                break
+            del expires[key]
+
+    def seen(self, key):
+        """窗口内是否已记录，不记录新键"""
+        self._expire(time.time())
+        return key in self.expires
+
+    def add(self, key):
+        """记录键，已记录的保持原来的过期时间"""
+        if key not in self.expires:
+            self.expires[key] = time.time() + self.window
+            self._dirty = True
+
+    def is_duplicate(self, key):
+        """窗口内已出现过返回 True，否则记录并返回 False"""
+        now = time.time()
+        self._expire(now)
+        if key in self.expires:
+            return True
+        self.expires[key] = now + self.window
+        self._dirty = True
+        return False
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"读取去重记录失败: {str(e)}")
+            return
+        now = time.time()
+        for *key, expires in entries:
+            if expires > now:
+                self.expires[tuple(key)] = expires
+
+    def _write(self, entries):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entries, f, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+
+    async def save(self):
+        """有新记录时写入磁盘，文件写入在线程中执行"""
+        if not self.path or not self._dirty:
+            return
+        self._dirty = False
+        self._expire(time.time())
+        entries = [[*key, expires] for key, expires in self.expires.items()]
+        try:
+            await asyncio.to_thread(self._write, entries)
+        except OSError as e:
+            logger.warning(f"保存去重记录失败: {str(e)}")
+
+    async def autosave(self, interval=30):
+        """定期保存，进程异常退出时最多丢失 interval 秒的记录"""
+        while True:
+            await asyncio.sleep(interval)
+            await self.save()
@@ -0,0 +1,180 @@
+import asyncio
+import json
+import os
+import time
+import logging
+from collections import OrderedDict
+from telethon.tl import types
+from telethon.tl.types import ChannelParticipantsAdmins
+from telethon.utils import get_display_name
+from routing import peer_id
+from retry import retry_call
+from logs import fields
+
+logger = logging.getLogger(__name__)
+
+# 聊天信息缓存：命令和 /list 只需要聊天的ID、名称和类型，
+# 缓存后不再每次调用 get_entity，避免触发 ResolveUsername 等接口的限流
+
+class ChatInfo:
+    """get_entity 结果中需要的部分"""
+    def __init__(self, id, title, chat_type, expires):
+        self.id = id
+        self.title = title
+        self.chat_type = chat_type  # channel, group（超级群组）, chat（普通群组）, private
+        self.expires = expires
+
+    @classmethod
+    def from_entity(cls, entity, expires):
+        if isinstance(entity, types.Channel):
+            chat_type = 'channel' if entity.broadcast else 'group'
+        elif isinstance(entity, types.Chat):
+            # 普通群组与超级群组的ID不在同一空间，需要单独区分
+            chat_type = 'chat'
+        elif isinstance(entity, types.User):
+            chat_type = 'private'
+        else:
+            chat_type = 'unknown'
+        title = getattr(entity, 'title', None) or get_display_name(entity) or str(entity.id)
+        return cls(entity.id, title, chat_type, expires)
+
+    def to_dict(self):
+        return {'id': self.id, 'title': self.title, 'chat_type': self.chat_type, 'expires': self.expires}
+
+def cache_key(source):
+    """链接统一格式，ID 统一为 Telethon 的真实ID"""
+    if isinstance(source, str) and 'https://t.me/' in source:
+        return source.strip().rstrip('/').lower()
+    return peer_id(source)
+
+class EntityCache:
+    """按ID和 t.me 链接缓存聊天信息，有过期时间和数量上限，保存到磁盘，重启后继续使用"""
+    def __init__(self, path, ttl=86400, capacity=10000):
+        self.path = path
+        self.ttl = ttl
+        self.capacity = capacity
+        self.entries = OrderedDict()  # 缓存键 -> ChatInfo，按最近使用排序
+        self._pending = {}  # 正在查询的缓存键 -> Future，同一个聊天同时只查询一次
+        self._dirty = False
+        self._save_lock = asyncio.Lock()  # 同一时间只有一个线程写临时文件
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"读取聊天信息缓存失败: {str(e)}")
+            return
+        now = time.time()
+        for key, info in data.items():
+            if info['expires'] > now:
+                # JSON 的键都是字符串，ID 需要转回整数
+                self.entries[key if key.startswith('https://') else int(key)] = ChatInfo(**info)
+
+    def _write(self, data):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    async def save(self):
+        """有新内容时写入磁盘，文件写入在线程中执行"""
+        async with self._save_lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            data = {key: info.to_dict() for key, info in self.entries.items()}
+            try:
+                await asyncio.to_thread(self._write, data)
+            except OSError as e:
+                logger.warning(f"保存聊天信息缓存失败: {str(e)}")
+
+    def get(self, source):
+        key = cache_key(source)
+        info = self.entries.get(key)
+        if info is None:
+            return None
+        if info.expires <= time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return info
+
+    def put(self, source, info):
+        for key in {cache_key(source), info.id}:
+            self.entries[key] = info
+            self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+        self._dirty = True
+
+    async def resolve(self, client, source):
+        """获取聊天信息，未命中时调用 get_entity，失败时抛出异常"""
+        info = await self._resolve(client, source)
+        await self.save()
+        return info
+
+    async def resolve_many(self, client, sources):
+        """并发获取多个聊天的信息，返回 {source: ChatInfo}，获取失败的为 None"""
+        results = await asyncio.gather(
+            *(self._resolve(client, source) for source in sources),
+            return_exceptions=True
+        )
+        await self.save()
+        return {
+            source: info if isinstance(info, ChatInfo) else None
+            for source, info in zip(sources, results)
+        }
+
+    async def _resolve(self, client, source):
+        info = self.get(source)
+        if info is not None:
+            return info
+        key = cache_key(source)
+        future = self._pending.get(key)
+        if future is None:
+            future = self._pending[key] = asyncio.ensure_future(self._fetch(client, source))
+            future.add_done_callback(lambda _: self._pending.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def _fetch(self, client, source):
+        entity = await retry_call(client.get_entity, source, name='get_entity')
+        info = ChatInfo.from_entity(entity, time.time() + self.ttl)
+        self.put(source, info)
+        return info
+
+class AdminCache:
+    """每个聊天的管理员ID集合，有过期时间，管理员变化时失效"""
+    def __init__(self, ttl=600):
+        self.ttl = ttl
+        self.entries = {}  # 聊天真实ID -> (过期时间, 管理员ID集合)
+        self._pending = {}  # 正在获取管理员列表的聊天ID -> Future
+
+    def invalidate(self, chat_id):
+        self.entries.pop(peer_id(chat_id), None)
+
+    async def is_admin(self, client, chat_id, user_id):
+        """判断用户是否是聊天的管理员，缓存命中时只需一次集合查找"""
+        key = peer_id(chat_id)
+        entry = self.entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            future = self._pending.get(key)
+            if future is None:
+                future = self._pending[key] = asyncio.ensure_future(self._fetch(client, chat_id, key))
+                future.add_done_callback(lambda _: self._pending.pop(key, None))
+            entry = await asyncio.shield(future)
+        return user_id in entry[1]
+
+    async def _fetch(self, client, chat_id, key):
+        try:
+            admins = await client.get_participants(chat_id, filter=ChannelParticipantsAdmins)
+            admin_ids = {admin.id for admin in admins}
+        except Exception as e:
+            # 没有权限查看管理员列表时按非管理员处理，同样缓存，避免每条命令都重新获取
+            logger.warning(f"获取管理员列表失败: {str(e)}", extra=fields(chat_id=chat_id))
+            admin_ids = set()
+        entry = (time.monotonic() + self.ttl, admin_ids)
+        self.entries[key] = entry
+        return entry
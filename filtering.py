@@ -0,0 +1,72 @@
+import logging
+from metrics import stage_seconds
+from logs import fields, truncate
+
+logger = logging.getLogger(__name__)
+
+# 按绑定的过滤模式和正则规则处理消息内容，只依赖路由表，
+# 主进程和分片工作进程共用
+
+def matches_filter(binding, message_text_lower):
+    """按绑定的过滤模式判断是否需要转发"""
+    # 检查是否匹配任何关键词（使用小写内容进行匹配）
+    with stage_seconds.time('match', binding.chat_id, binding.target_chat_id):
+        matched_words = binding.keywords.find_all(message_text_lower)
+    matched = bool(matched_words)
+    if matched and logger.isEnabledFor(logging.DEBUG):
+        logger.debug("匹配关键字", extra=fields(
+            source=binding.chat_id, target=binding.target_chat_id, keywords=sorted(matched_words)
+        ))
+
+    # 据过滤模式决定是否转发
+    return (
+        (binding.filter_mode == 'whitelist' and matched) or
+        (binding.filter_mode == 'blacklist' and not matched)
+    )
+
+def apply_regex(binding, content):
+    """使用来源的正则规则依次处理消息内容"""
+    source_format = binding.format
+    pipeline = source_format.regex
+    if not pipeline:
+        return content
+
+    with stage_seconds.time('regex', binding.chat_id, binding.target_chat_id):
+        # 使用正则表达式替换内容，保留链接部分
+        if '[' in content and '](' in content:
+            # 处理带链接的文本
+            parts = content.split('](')
+            text_part = parts[0][1:]  # 移除开头的 [
+            link_part = parts[1]  # 包含链接和可能的其他文本
+
+            # 只处理文本部分
+            text_part = pipeline.apply(text_part)
+            content = f'[{text_part}]({link_part}'
+        else:
+            # 处理普通文本
+            content = pipeline.apply(content)
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("正则处理", extra=fields(
+            source=binding.chat_id, target=binding.target_chat_id,
+            patterns=[pattern.pattern for pattern, _ in pipeline.rules],
+            content=truncate(content), parse_mode=source_format.parse_mode
+        ))
+    return content
+
+def format_bindings(bindings, message_text, media=False):
+    """对来源的各个绑定过滤和格式化，返回 ([(目标ID, 内容)], [被过滤的目标ID])
+
+    文字消息处理后内容为空时不发送；媒体的说明文字可以为空。
+    """
+    message_text_lower = message_text.lower()
+    targets = []
+    filtered = []
+    for binding in bindings:
+        if not matches_filter(binding, message_text_lower):
+            filtered.append(binding.target_chat_id)
+            continue
+        content = apply_regex(binding, message_text)
+        if media or content.strip():
+            targets.append((binding.target_chat_id, content))
+    return targets, filtered
@@ -0,0 +1,75 @@
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+
+# 结构化日志：每条日志一行 JSON。
+# 事件循环中只把日志记录放入队列，由单独的线程格式化并写入标准输出，写日志不会阻塞事件循环。
+
+DEBUG = os.getenv('DEBUG', 'false').lower() == 'true'
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', '0.01'))  # 高频事件（每条消息一次）在非调试模式下的记录比例
+LOG_MAX_CONTENT = int(os.getenv('LOG_MAX_CONTENT', '200'))  # 日志中消息内容的最大长度
+
+class JsonFormatter(logging.Formatter):
+    """日志记录转为一行 JSON，extra={'fields': {...}} 中的字段合并到顶层"""
+    def format(self, record):
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + f'.{int(record.msecs):03d}',
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # 格式化交给写日志的线程，这里只展开参数，不生成 JSON
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def setup_logging(stream=None):
+    """配置根日志器，返回已启动的 QueueListener，退出前需要调用 stop() 写完剩余日志"""
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(log_queue, handler)
+
+    root = logging.getLogger()
+    root.handlers[:] = [_QueueHandler(log_queue)]
+    root.setLevel(logging.DEBUG if DEBUG else logging.INFO)
+    # 第三方库的调试日志过多，只在调试模式下保留 INFO
+    for name in ('telethon', 'httpx', 'telegram', 'sqlalchemy', 'aiosqlite'):
+        logging.getLogger(name).setLevel(logging.INFO if DEBUG else logging.WARNING)
+
+    listener.start()
+    return listener
+
+def fields(**values):
+    """日志的结构化字段：logger.info('...', extra=fields(source=...))"""
+    return {'fields': values}
+
+def sampled():
+    """高频事件是否记录：调试模式下全部记录，否则按 LOG_SAMPLE_RATE 采样"""
+    return DEBUG or random.random() < LOG_SAMPLE_RATE
+
+def truncate(text, limit=None):
+    """截断日志中的消息内容"""
+    limit = LOG_MAX_CONTENT if limit is None else limit
+    if text is None or len(text) <= limit:
+        return text
+    return text[:limit] + f'...({len(text)})'
@@ -1,20 +1,43 @@
 import os
+import asyncio
 from dotenv import load_dotenv
-from telethon import TelegramClient, events
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, Message
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
-from models import Session, Source, Keyword, init_db, MessageFormat, RegexFormat, PreviewSetting
+from telethon import events
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, InputMediaVideo, InputMediaAudio, InputMediaDocument, Message
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, ContextTypes, filters
+from models import engine, Session, Source, Keyword, init_db, insert_ignore, write_session, MessageFormat, RegexFormat, PreviewSetting
+from routing import routing_table, peer_id
+from sender import SendScheduler
+from outbox import Outbox
+from media import MediaDownloader
+from pipeline import SourceQueues
+from entities import EntityCache, AdminCache
+from retry import retry_on_server_error, retry_counters
+from dedup import DedupWindow
+from message_map import MessageMap
+from catchup import Checkpoints, catch_up
+from filtering import format_bindings
+from shards import ShardPool
+from accounts import AccountPool
+from logs import setup_logging, fields, sampled, truncate
+from metrics import Gauge, stage_seconds, events_total, forwarded_total, serve as serve_metrics
 from math import ceil
 import tempfile
 from telegram.constants import ParseMode
 import time
-from collections import defaultdict, OrderedDict
-from telethon.errors import ServerError
+from collections import defaultdict
+from telethon.errors import SessionPasswordNeededError
 import shutil
-from telethon.tl.types import ChannelParticipantsAdmins
+import re
+import io
+import logging
+from sqlalchemy import select, delete, func
+from telethon.tl import types
+from telegram.error import BadRequest
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Telegram API credentials
 API_ID = os.getenv('API_ID')
 API_HASH = os.getenv('API_HASH')
@@ -26,58 +49,154 @@ PHONE_NUMBER = os.getenv('PHONE_NUMBER')
 # 确保 sessions 目录存在
 os.makedirs('sessions', exist_ok=True)
 
-client = TelegramClient(
-    'sessions/forwarder_session',
-    API_ID,
-    API_HASH,
-    connection_retries=None,  # 无限重试
-    retry_delay=1  
-)
-
-# Debug mode
-DEBUG = os.getenv('DEBUG', 'false').lower() == 'true'
+# 接收消息的用户账号（sessions 目录下的会话名称，逗号分隔），第一个为主账号
+ACCOUNTS = [name.strip() for name in os.getenv('ACCOUNTS', 'forwarder_session').split(',') if name.strip()]
+accounts = AccountPool(ACCOUNTS, API_ID, API_HASH)
+# 主账号的客户端，用于命令中的聊天信息查询
+client = accounts.primary.client
 
 # 添加新的常量
 ITEMS_PER_PAGE = 5  # 每页显示的项目数
 
+# 同时向多个目标发送的并发上限
+FORWARD_CONCURRENCY = int(os.getenv('FORWARD_CONCURRENCY', '10'))
+
+# 出站限速：全局每秒条数、私聊每秒条数、群组/频道每分钟条数
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', '30'))
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', '1'))
+SEND_GROUP_RATE = float(os.getenv('SEND_GROUP_RATE', '20'))
+
+send_scheduler = SendScheduler(
+    workers=FORWARD_CONCURRENCY,
+    global_rate=SEND_GLOBAL_RATE,
+    chat_rate=SEND_CHAT_RATE,
+    group_rate=SEND_GROUP_RATE
+)
+
+# 持久化发件箱，保存已接收但尚未发送完成的转发任务
+outbox = Outbox(os.getenv('OUTBOX_PATH', 'data/outbox.db'))
+OUTBOX_DRAIN_BATCH = 100  # 每次从发件箱取出的任务数
+
+# 来源队列：工作协程数、每个来源的队列长度、队列满时的处理方式(block/drop_oldest/spill)
+SOURCE_WORKERS = int(os.getenv('SOURCE_WORKERS', '8'))
+SOURCE_QUEUE_SIZE = int(os.getenv('SOURCE_QUEUE_SIZE', '100'))
+SOURCE_QUEUE_OVERFLOW = os.getenv('SOURCE_QUEUE_OVERFLOW', 'block')
+
 # 添加消息组缓存
 message_groups = defaultdict(list)
 last_message_time = defaultdict(float)
 GROUP_TIME_WINDOW = 1.0  # 1秒内的消息视为同一组
 
-# 添加一个消息ID缓存
-class LRUCache:
-    def __init__(self, capacity=100):
-        self.cache = OrderedDict()
-        self.capacity = capacity
-
-    def get(self, key):
-        if key not in self.cache:
-            return False
-        self.cache.move_to_end(key)
-        return True
-
-    def put(self, key):
-        if key in self.cache:
-            self.cache.move_to_end(key)
-        else:
-            if len(self.cache) >= self.capacity:
-                self.cache.popitem(last=False)
-            self.cache[key] = True
-
-# 创建消息缓存实例
-message_cache = LRUCache()
-
-class Timer:
-    def __init__(self, time_between=2):
-        self.start_time = time.time()
-        self.time_between = time_between
-
-    def can_send(self):
-        if time.time() > (self.start_time + self.time_between):
-            self.start_time = time.time()
-            return True
-        return False
+# 媒体转发：同时处理中的媒体总字节数上限、单个文件大小上限（Bot API 限制为 50MB）
+MB = 1024 * 1024
+media_downloader = MediaDownloader(
+    memory_limit=int(os.getenv('MEDIA_MEMORY_LIMIT_MB', '200')) * MB,
+    max_size=int(os.getenv('MEDIA_MAX_SIZE_MB', '50')) * MB
+)
+
+# 聊天信息缓存，减少命令和 /list 中的 get_entity 调用
+entity_cache = EntityCache(
+    os.getenv('ENTITY_CACHE_PATH', 'data/entities.json'),
+    ttl=int(os.getenv('ENTITY_CACHE_TTL', '86400'))
+)
+
+# 频道管理员缓存，用于判断频道中的命令是否由 USER_ID 发送
+admin_cache = AdminCache(ttl=int(os.getenv('ADMIN_CACHE_TTL', '600')))
+
+# 来源消息与转发副本的对应关系，用于同步编辑和删除
+message_map = MessageMap(
+    os.getenv('MESSAGE_MAP_PATH', 'data/message_map.db'),
+    ttl=int(os.getenv('MESSAGE_MAP_TTL', '604800'))
+)
+EDIT_DEBOUNCE = float(os.getenv('EDIT_DEBOUNCE', '2'))  # 同一条消息在这段时间内的多次编辑只同步一次
+PROPAGATE_DELETES = os.getenv('PROPAGATE_DELETES', 'false').lower() == 'true'
+
+# 停机补发：启动时从每个来源最后处理的消息开始补发，每个来源最多补发的条数、同时补发的来源数
+CATCHUP = os.getenv('CATCHUP', 'true').lower() == 'true'
+CATCHUP_LIMIT = int(os.getenv('CATCHUP_LIMIT', '1000'))
+CATCHUP_CONCURRENCY = int(os.getenv('CATCHUP_CONCURRENCY', '4'))
+checkpoints = Checkpoints()
+
+# 正在补发的来源 -> 补发期间收到的实时消息，补发完成后再入队，保证来源内的顺序
+catching_up = {}
+
+# 分片工作进程数：大于 0 时关键字匹配和正则处理按来源分片交给多个进程，0 为单进程
+SHARDS = int(os.getenv('SHARDS', '0'))
+shard_pool = ShardPool(SHARDS) if SHARDS > 0 else None
+
+# 指标 HTTP 端口（Prometheus 格式，路径 /metrics），为空时不启动
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = os.getenv('METRICS_PORT', '')
+
+# 等待同步的编辑：(来源ID, 消息ID) -> 最新的编辑事件
+pending_edits = {}
+
+# 后台任务引用，防止任务被垃圾回收
+background_tasks = set()
+
+# 消息去重：窗口内已处理过的 (聊天ID, 消息ID) 不再处理，保存到磁盘，重启后不会重复转发
+message_dedup = DedupWindow(
+    window=int(os.getenv('DEDUP_WINDOW', '600')),
+    path=os.getenv('DEDUP_PATH', 'data/dedup.json') or None
+)
+
+async def is_target_chat(session, chat_id):
+    """检查窗口是否是某个绑定的目标窗口"""
+    return await session.scalar(
+        select(Source.id).where(Source.target_chat_id == chat_id).limit(1)
+    ) is not None
+
+async def resolve_source(update, source):
+    """解析命令中的来源ID或链接，返回 (chat_id, 名称)，无效时回复错误并返回 None"""
+    # 处理链接格式
+    if 'https://t.me/' in source:
+        try:
+            chat = await entity_cache.resolve(client, source)
+        except Exception as e:
+            await update.message.reply_text(f"❌ 获取聊天信息失败: {str(e)}")
+            return None
+        return chat.id, chat.title
+    
+    chat_id = peer_id(source)
+    if chat_id is None:
+        await update.message.reply_text("❌ 无效的来源ID")
+        return None
+    try:
+        chat = await entity_cache.resolve(client, int(source))
+        return chat_id, chat.title
+    except Exception:
+        return chat_id, source
+
+async def place_source(source):
+    """解析 /binding 的来源并选择接收账号，返回 (ChatInfo, Account)
+
+    已绑定过的来源沿用原来的账号；新来源按负责的来源数从少到多，选第一个能接收该来源消息的账号。
+    """
+    error = None
+    for account in accounts.by_load():
+        try:
+            chat = await entity_cache.resolve(account.client, source)
+        except Exception as e:
+            error = e
+            continue
+        owner = accounts.owner(chat.id)
+        if owner is not None:
+            return chat, owner
+        # 只有一个账号时保持原来的行为，不检查是否已加入
+        if len(accounts) == 1 or await accounts.subscribe(account, source):
+            return chat, account
+    raise error or ValueError("没有可以接收该来源消息的账号")
+
+async def describe_bindings(sources, attr):
+    """生成绑定列表的显示内容，attr 为要显示的聊天ID字段，未缓存的聊天并发获取"""
+    chats = await entity_cache.resolve_many(client, list(dict.fromkeys(getattr(source, attr) for source in sources)))
+    lines = []
+    for source in sources:
+        chat_id = getattr(source, attr)
+        chat = chats[chat_id]
+        mode = '白名单' if source.filter_mode == 'whitelist' else '黑名单'
+        lines.append(f"- {chat.title} ({chat_id}) [{mode}]" if chat else f"- {chat_id} [{mode}]")
+    return lines
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != USER_ID:
@@ -91,12 +210,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "3. /add <关键字> - 添加当前窗口的过滤关键字\n"
         "4. /remove <关键字> - 删除当前窗口的过滤关键字\n"
         "5. /list - 查看当前窗口的配置信息\n"
-        "6. /export - 导出当前窗口的关键字列表\n"
+        "6. /export - 导出当前窗口的关键字列表（/import 回复文件可批量导入）\n"
         "7. /switch <来源ID或链接> <格式> - 设置指定来源的消息格式(html/markdown)\n"
-        "8. /regex <来源ID或链接> <正则表达式> [格式] - 设置正则表达式消息格式\n"
+        "8. /regex <来源ID或链接> <正则表达式> [格式] - 添加正则表达式规则（可添加多条，按顺序应用）\n"
         "9. /regex_list <来源ID或链接> - 查看正则表达式规则\n"
-        "10. /regex_remove <来源ID或链接> - 移除正则表达式规则\n"
-        "11. /preview <来源ID或链接> <on/off> - 设置链接预览开关\n\n"
+        "10. /regex_remove <来源ID或链接> [序号] - 移除正则表达式规则\n"
+        "11. /preview <来源ID或链接> <on/off> - 设置链接预览开关\n"
+        "12. /status - 查看转发队列状态\n\n"
         "🤖 机器人已准备就绪！"
     )
 
@@ -108,113 +228,129 @@ async def binding(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("请提供源聊天窗口 ID 或链接")
         return
     
-    session = Session()
     try:
         # 获取当前聊天窗口ID（作为目标）
-        target_chat_id = str(update.effective_chat.id)
+        target_chat_id = update.effective_chat.id
         bound_sources = []
+        resolved = []  # (chat_id, chat_type, 接收账号, 显示名称)
         
-        # 添加新绑定
+        # 先解析所有来源，并为新来源选择接收账号
         for source in context.args:
             # 处理链接格式
             if 'https://t.me/' in source:
                 try:
-                    chat = await client.get_entity(source)
-                    chat_id = str(chat.id)
-                    chat_type = 'channel' if chat.broadcast else 'group' if chat.megagroup else 'private'
-                    source_title = chat.title
-                    bound_sources.append(f"{source_title} ({chat_id})")
+                    chat, account = await place_source(source)
+                    chat_id = chat.id
+                    chat_type = chat.chat_type
+                    bound_sources.append(f"{chat.title} ({chat_id})")
                 except Exception as e:
-                    print(f"获取聊天ID失败: {str(e)}")
+                    logger.warning(f"获取聊天ID失败: {str(e)}", extra=fields(source=source))
                     bound_sources.append(f"未知 ({source})")
                     continue
             else:
-                chat_id = source
+                chat_id = peer_id(source)
+                if chat_id is None:
+                    bound_sources.append(f"无效的ID ({source})")
+                    await update.message.reply_text(f"❌ 无效的来源ID: {source}")
+                    continue
                 try:
-                    chat = await client.get_entity(int(chat_id))
-                    chat_type = 'channel' if chat.broadcast else 'group' if chat.megagroup else 'private'
-                    source_title = chat.title
-                    bound_sources.append(f"{source_title} ({chat_id})")
-                except:
+                    chat, account = await place_source(int(source))
+                    chat_type = chat.chat_type
+                    bound_sources.append(f"{chat.title} ({chat_id})")
+                except Exception:
                     chat_type = 'unknown'
-                    bound_sources.append(chat_id)
+                    account = accounts.owner(chat_id) or accounts.primary
+                    bound_sources.append(str(chat_id))
+            resolved.append((chat_id, chat_type, account, bound_sources[-1]))
+        
+        # 检查是否已经绑定，记录每个来源是否为新绑定
+        created = []
+        if resolved:
+            async with write_session() as session:
+                existing = set(await session.scalars(
+                    select(Source.chat_id).where(
+                        Source.target_chat_id == target_chat_id,
+                        Source.chat_id.in_([chat_id for chat_id, _, _, _ in resolved])
+                    )
+                ))
+                for chat_id, chat_type, account, _ in resolved:
+                    if chat_id in existing:
+                        created.append(False)
+                        continue
+                    session.add(Source(
+                        chat_id=chat_id,
+                        target_chat_id=target_chat_id,
+                        chat_type=chat_type,
+                        filter_mode='whitelist',  # 默认使用白名单模式
+                        account=account.name
+                    ))
+                    existing.add(chat_id)
+                    created.append(True)
+        
+        for (chat_id, _, account, title), is_new in zip(resolved, created):
+            if not is_new:
+                await update.message.reply_text(f"⚠️ 已存在的绑定: {title}")
+                continue
             
-            # 检查是否已经绑定
-            existing = session.query(Source).filter(
-                Source.chat_id == chat_id,
-                Source.target_chat_id == target_chat_id
-            ).first()
+            # 同步更新路由表和接收账号
+            routing_table.add_binding(chat_id, target_chat_id, 'whitelist')
+            accounts.assign(chat_id, account)
             
-            if not existing:
-                new_source = Source(
-                    chat_id=chat_id,
-                    target_chat_id=target_chat_id,
-                    chat_type=chat_type,
-                    filter_mode='whitelist'  # 默认使用白名单模式
-                )
-                session.add(new_source)
-                
-                # 创建模式选择按钮
-                keyboard = [
-                    [
-                        InlineKeyboardButton("白名单模式", callback_data=f"mode_whitelist_{chat_id}"),
-                        InlineKeyboardButton("黑名单模式", callback_data=f"mode_blacklist_{chat_id}")
-                    ]
+            # 创建模式选择按钮
+            keyboard = [
+                [
+                    InlineKeyboardButton("白名单模式", callback_data=f"mode_whitelist_{chat_id}"),
+                    InlineKeyboardButton("黑名单模式", callback_data=f"mode_blacklist_{chat_id}")
                 ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await update.message.reply_text(
-                    f"✅ 绑定成功\n"
-                    f"📤 来源: {bound_sources[-1]}\n"
-                    f"📥 目标: 当前聊天窗口\n\n"
-                    f"请选择此绑定选择过滤模：",
-                    reply_markup=reply_markup
-                )
-            else:
-                await update.message.reply_text(f"⚠️ 已存在的绑定: {bound_sources[-1]}")
-        
-        session.commit()
+            ]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            
+            # 多账号时显示接收消息的账号
+            account_line = f"📡 接收账号: {account.name}\n" if len(accounts) > 1 else ""
+            await update.message.reply_text(
+                f"✅ 绑定成功\n"
+                f"📤 来源: {title}\n"
+                f"📥 目标: 当前聊天窗口\n"
+                f"{account_line}\n"
+                f"请选择此绑定选择过滤模：",
+                reply_markup=reply_markup
+            )
         
         if not bound_sources:
             await update.message.reply_text("❌ 没有添加任何有效的来源")
             return
         
-        # 打印试信息
-        print("\n绑定信息：")
-        print(f"📤 已绑定来源: {', '.join(bound_sources)}")
-        print(f"📥 目标: {target_chat_id}")
+        logger.info("绑定来源", extra=fields(sources=bound_sources, target=target_chat_id))
         
     except Exception as e:
-        print(f"绑定过程出错: {str(e)}")
+        logger.exception(f"绑定过程出错: {str(e)}")
         await update.message.reply_text(f"❌ 绑定失败: {str(e)}")
-    finally:
-        session.close()
 
 async def unbinding(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """解除当前窗口的所有绑定"""
     if update.effective_user.id != USER_ID:
         return
     
-    session = Session()
+    current_chat_id = update.effective_chat.id
+    
     try:
-        current_chat_id = str(update.effective_chat.id)
-        
-        # 删除当前口作为目标的所有绑定
-        target_bindings = session.query(Source).filter(
-            Source.target_chat_id == current_chat_id
-        ).delete()
-        
-        # 删除当前窗作为来源的所有绑定
-        source_bindings = session.query(Source).filter(
-            Source.chat_id == current_chat_id
-        ).delete()
-        
-        # 如果是目窗口，同时删除其关键字
-        session.query(Keyword).filter(
-            Keyword.target_chat_id == current_chat_id
-        ).delete()
-        
-        session.commit()
+        async with write_session() as session:
+            # 删除当前口作为目标的所有绑定
+            target_bindings = (await session.execute(
+                delete(Source).where(Source.target_chat_id == current_chat_id)
+            )).rowcount
+            
+            # 删除当前窗作为来源的所有绑定，来源保存的是不带前缀的真实ID
+            source_bindings = (await session.execute(
+                delete(Source).where(Source.chat_id == peer_id(current_chat_id))
+            )).rowcount
+            
+            # 如果是目窗口，同时删除其关键字
+            await session.execute(
+                delete(Keyword).where(Keyword.target_chat_id == current_chat_id)
+            )
+        routing_table.remove_chat(current_chat_id)
+        accounts.retain(routing_table.bindings)
         
         if target_bindings or source_bindings:
             await update.message.reply_text("✅ 已解除当前窗口的所有绑定关系")
@@ -223,8 +359,6 @@ async def unbinding(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     except Exception as e:
         await update.message.reply_text(f"❌ 解绑失败: {str(e)}")
-    finally:
-        session.close()
 
 async def add_keywords(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """添加当前窗口的关键字"""
@@ -236,63 +370,56 @@ async def add_keywords(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # 检查消息是否已经处理过
-    message_id = f"{update.effective_chat.id}_{update.message.message_id}"
-    if message_cache.get(message_id):
+    if message_dedup.is_duplicate((update.effective_chat.id, update.message.message_id)):
         return
-    message_cache.put(message_id)
     
-    session = Session()
-    try:
-        current_chat_id = str(update.effective_chat.id)
-        
+    current_chat_id = update.effective_chat.id
+    # 将关键字转换为小写并去重，保持输入顺序
+    words = list(dict.fromkeys(word.lower() for word in context.args))
+    
+    existing = None
+    async with write_session() as session:
         # 检查当前窗口否是目标窗口
-        source = session.query(Source).filter(
-            Source.target_chat_id == current_chat_id
-        ).first()
-        
-        if not source:
-            await update.message.reply_text("❌ 只能在目标窗口中管理关键字")
-            return
-        
-        added_words = []
-        existed_words = []
+        filter_mode = await session.scalar(
+            select(Source.filter_mode).where(Source.target_chat_id == current_chat_id).limit(1)
+        )
         
-        for word in context.args:
-            # 将关键字转换为小写
-            word = word.lower()
-            
-            # 检查关键字是否已存在
-            existing = session.query(Keyword).filter(
-                Keyword.target_chat_id == current_chat_id,
-                Keyword.word == word
-            ).first()
-            
-            if existing:
-                existed_words.append(word)
-                continue
+        if filter_mode:
+            # 一次查询所有已存在的关键字
+            existing = set(await session.scalars(
+                select(Keyword.word).where(
+                    Keyword.target_chat_id == current_chat_id,
+                    Keyword.word.in_(words)
+                )
+            ))
             
             # 添加小写的关键字
-            keyword = Keyword(
-                target_chat_id=current_chat_id,
-                word=word,
-                is_whitelist=(source.filter_mode == 'whitelist')
-            )
-            session.add(keyword)
-            added_words.append(word)
-        
-        session.commit()
-        
-        # 构建响应消息
-        response_parts = []
-        if added_words:
-            response_parts.append(f"✅ 已添加关键字: {', '.join(added_words)}")
-        if existed_words:
-            response_parts.append(f"⚠️ 已存在的关键字: {', '.join(existed_words)}")
-        
-        await update.message.reply_text("\n".join(response_parts) or "没有添加任何关键字")
+            session.add_all([
+                Keyword(
+                    target_chat_id=current_chat_id,
+                    word=word,
+                    is_whitelist=(filter_mode == 'whitelist')
+                )
+                for word in words
+                if word not in existing
+            ])
     
-    finally:
-        session.close()
+    if existing is None:
+        await update.message.reply_text("❌ 只能在目标窗口中管理关键字")
+        return
+    
+    existed_words = [word for word in words if word in existing]
+    added_words = [word for word in words if word not in existing]
+    routing_table.add_keywords(current_chat_id, added_words)
+    
+    # 构建响应消息
+    response_parts = []
+    if added_words:
+        response_parts.append(f"✅ 已添加关键字: {', '.join(added_words)}")
+    if existed_words:
+        response_parts.append(f"⚠️ 已存在的关键字: {', '.join(existed_words)}")
+    
+    await update.message.reply_text("\n".join(response_parts) or "没有添加任何关键字")
 
 async def remove_keywords(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """删除当前窗口的关键字"""
@@ -303,88 +430,68 @@ async def remove_keywords(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("请提供要删除的关键字")
         return
     
-    session = Session()
-    try:
-        current_chat_id = str(update.effective_chat.id)
-        
+    current_chat_id = update.effective_chat.id
+    # 将要删除的关键字转换为小写并去重
+    words = list(dict.fromkeys(word.lower() for word in context.args))
+    
+    existing = None
+    async with write_session() as session:
         # 检查当前窗口是否是目标窗口
-        is_target = session.query(Source).filter(
-            Source.target_chat_id == current_chat_id
-        ).first() is not None
-        
-        if not is_target:
-            await update.message.reply_text("❌ 只能在目标窗口中管理关键字")
-            return
-        
-        removed_words = []
-        not_found_words = []
-        
-        for word in context.args:
-            # 将要删除的关键字转换为小写
-            word = word.lower()
-            
+        if await is_target_chat(session, current_chat_id):
             # 只删除当前窗口的关键字
-            result = session.query(Keyword).filter(
-                Keyword.target_chat_id == current_chat_id,
-                Keyword.word == word
-            ).delete()
-            
-            if result:
-                removed_words.append(word)
-            else:
-                not_found_words.append(word)
-        
-        session.commit()
-        
-        # 构建响应消息
-        response_parts = []
-        if removed_words:
-            response_parts.append(f"✅ 已删除关键字: {', '.join(removed_words)}")
-        if not_found_words:
-            response_parts.append(f"❓ 未找到关键字: {', '.join(not_found_words)}")
-        
-        await update.message.reply_text("\n".join(response_parts) or "没有删除任何关键字")
+            existing = set(await session.scalars(
+                select(Keyword.word).where(
+                    Keyword.target_chat_id == current_chat_id,
+                    Keyword.word.in_(words)
+                )
+            ))
+            if existing:
+                await session.execute(
+                    delete(Keyword).where(
+                        Keyword.target_chat_id == current_chat_id,
+                        Keyword.word.in_(existing)
+                    )
+                )
     
-    finally:
-        session.close()
+    if existing is None:
+        await update.message.reply_text("❌ 只能在目标窗口中管理关键字")
+        return
+    
+    removed_words = [word for word in words if word in existing]
+    not_found_words = [word for word in words if word not in existing]
+    routing_table.remove_keywords(current_chat_id, removed_words)
+    
+    # 构建响应消息
+    response_parts = []
+    if removed_words:
+        response_parts.append(f"✅ 已删除关键字: {', '.join(removed_words)}")
+    if not_found_words:
+        response_parts.append(f"❓ 未找到关键字: {', '.join(not_found_words)}")
+    
+    await update.message.reply_text("\n".join(response_parts) or "没有删除任何关键字")
 
 async def mode_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
     mode, source_chat_id = query.data.split('_')[1:]
+    source_chat_id = int(source_chat_id)
+    target_chat_id = update.effective_chat.id
     
-    session = Session()
-    try:
-        source = session.query(Source).filter(
-            Source.chat_id == source_chat_id,
-            Source.target_chat_id == str(update.effective_chat.id)
-        ).first()
+    async with write_session() as session:
+        source = await session.scalar(
+            select(Source).where(
+                Source.chat_id == source_chat_id,
+                Source.target_chat_id == target_chat_id
+            )
+        )
         
         if source:
             source.filter_mode = mode
-            session.commit()
-            await query.edit_message_text(f"已将 {source.chat_id} 的转发模式设置为 {mode} 模式！")
-    finally:
-        session.close()
-
-# 添加重试装饰器
-def retry_on_server_error(max_retries=3, delay=1):
-    def decorator(func):
-        async def wrapper(*args, **kwargs):
-            retries = 0
-            while retries < max_retries:
-                try:
-                    return await func(*args, **kwargs)
-                except ServerError as e:
-                    retries += 1
-                    if retries == max_retries:
-                        raise e
-                    print(f"服务器连接错误，{delay}秒后重试 ({retries}/{max_retries})")
-                    time.sleep(delay)
-            return None
-        return wrapper
-    return decorator
+    
+    if source:
+        routing_table.set_filter_mode(source_chat_id, target_chat_id, mode)
+        await query.edit_message_text(f"已将 {source_chat_id} 的转发模式设置为 {mode} 模式！")
 
 @retry_on_server_error(max_retries=3)
 async def get_media_group_messages(client, entity, min_id, max_id, limit):
@@ -395,38 +502,370 @@ async def get_media_group_messages(client, entity, min_id, max_id, limit):
         limit=limit
     )
 
-async def handle_new_message(event):
-    global regex_format, preview_setting
+async def format_targets(chat_id, bindings, message_text, media=False):
+    """过滤和格式化，返回需要转发的 [(binding, 内容)]，分片模式下交给来源所属的工作进程处理"""
+    result = None
+    if shard_pool is not None:
+        started = time.perf_counter()
+        result = await shard_pool.format(chat_id, message_text, media)
+        stage_seconds.observe(time.perf_counter() - started, 'shard', chat_id, '')
+    if result is None:
+        result = format_bindings(bindings, message_text, media)
+    targets, filtered = result
     
-    # 检查消息是否已经处理过
-    message_id = f"{event.chat_id}_{event.message.id}"
-    if message_cache.get(message_id):
+    by_target = {binding.target_chat_id: binding for binding in bindings}
+    for target_chat_id in filtered:
+        if target_chat_id in by_target:
+            forwarded_total.inc(chat_id, target_chat_id, 'filtered')
+    # 工作进程可能还没有加载最新的配置，只保留当前仍存在的绑定
+    return [(by_target[target_chat_id], content) for target_chat_id, content in targets if target_chat_id in by_target]
+
+async def deliver(chat_id, kwargs, job_id=None, source=None):
+    """通过调度器发送，完成后从发件箱中移除任务"""
+    # 发件箱重放的任务没有来源
+    source_id = source[0] if source is not None else ''
+    started = time.perf_counter()
+    try:
+        sent = await send_scheduler.send_message(chat_id, **kwargs)
+        forwarded_total.inc(source_id, chat_id, 'sent')
+        if source is not None:
+            message_map.add(source, chat_id, sent.message_id)
+    except Exception as e:
+        forwarded_total.inc(source_id, chat_id, 'failed')
+        logger.error(f"发送消息时出错: {str(e)}", extra=fields(source=source_id, target=chat_id))
+    stage_seconds.observe(time.perf_counter() - started, 'send', source_id, chat_id)
+    # 发送失败（非限流）时同样移除，避免重启后反复重放
+    if job_id is not None:
+        outbox.done(job_id)
+
+def build_send_kwargs(binding, content):
+    source_format = binding.format
+    return {
+        'text': content,
+        'parse_mode': ParseMode.HTML if source_format.parse_mode == 'html' else ParseMode.MARKDOWN,
+        'disable_web_page_preview': source_format.disable_preview
+    }
+
+async def send_to_target(binding, content, source):
+    """写入发件箱后交给发送调度器，错误只影响当前目标，返回发送任务"""
+    kwargs = build_send_kwargs(binding, content)
+    # 先写入发件箱再发送
+    try:
+        job_id = await outbox.add(binding.target_chat_id, kwargs)
+    except Exception:
+        job_id = None
+    # 不等待发送完成，慢目标不会阻塞来源队列；调度器按入队顺序发送，目标内顺序不变
+    return spawn(deliver(binding.target_chat_id, kwargs, job_id, source))
+
+async def drain_outbox():
+    """把发件箱中未交给发送流程的任务（上次运行遗留的、队列溢出写入的）分批发送"""
+    while True:
+        try:
+            if sum(send_scheduler.pending().values()) < OUTBOX_DRAIN_BATCH:
+                jobs = await outbox.claim(OUTBOX_DRAIN_BATCH)
+                for job_id, chat_id, kwargs in jobs:
+                    spawn(deliver(chat_id, kwargs, job_id))
+                if jobs:
+                    continue
+        except Exception as e:
+            logger.error(f"读取发件箱失败: {str(e)}")
+        await asyncio.sleep(1)
+
+def source_key(chat_id, message):
+    """消息对应关系的键：(来源真实ID, 消息ID)"""
+    return (chat_id, message.id)
+
+class MessageEdit:
+    """来源队列中的编辑事件，和新消息按来源内的顺序处理"""
+    def __init__(self, event):
+        self.event = event
+
+def buffer_edit(event):
+    """缓存编辑事件，同一条消息在 EDIT_DEBOUNCE 秒内的多次编辑只同步最后一次"""
+    key = source_key(peer_id(event.chat_id), event.message)
+    if key not in pending_edits:
+        asyncio.get_running_loop().call_later(EDIT_DEBOUNCE, flush_edit, key)
+    pending_edits[key] = event
+
+def flush_edit(key):
+    # 经过来源队列，确保原消息已经处理过
+    spawn(source_queues.put(key[0], MessageEdit(pending_edits.pop(key))))
+
+async def sync_edit(event):
+    """把来源消息的编辑同步到各目标中的副本，没有副本时不转发"""
+    message = event.message
+    key = source_key(peer_id(event.chat_id), message)
+    await message_map.settled(key)
+    copies = await message_map.lookup(key)
+    if not copies:
         return
-    message_cache.put(message_id)
     
-    # 检查是否是命令消息
-    if event.message.text and event.message.text.startswith('/'):
-        # 获取发送者权限
-        chat = await event.get_chat()
-        sender = None
-        
+    copies = dict(copies)
+    bindings = [binding for binding in routing_table.get(key[0]) if binding.target_chat_id in copies]
+    media = has_media(message)
+    # 编辑后不再满足过滤条件时保留原副本
+    for binding, content in await format_targets(key[0], bindings, message.text or '', media):
+        if media:
+            parse_mode = ParseMode.HTML if binding.format.parse_mode == 'html' else ParseMode.MARKDOWN
+            method = 'edit_message_caption'
+            kwargs = {'caption': content, 'parse_mode': parse_mode}
+        else:
+            method = 'edit_message_text'
+            kwargs = build_send_kwargs(binding, content)
+        spawn(edit_copy(method, binding.target_chat_id, copies[binding.target_chat_id], kwargs))
+
+async def edit_copy(method, chat_id, message_id, kwargs):
+    try:
+        await send_scheduler.send(method, chat_id, message_id=message_id, **kwargs)
+    except BadRequest as e:
+        # 正则处理后内容没有变化
+        if 'not modified' not in str(e):
+            logger.error(f"同步编辑时出错: {str(e)}", extra=fields(target=chat_id, message_id=message_id))
+    except Exception as e:
+        logger.error(f"同步编辑时出错: {str(e)}", extra=fields(target=chat_id, message_id=message_id))
+
+async def delete_copies(key):
+    """删除来源消息在各目标中的副本"""
+    await message_map.settled(key)
+    for target_chat_id, message_id in await message_map.pop(key):
         try:
-            # 于频道消息，检查发送者是否是管理员
-            if event.is_channel:
-                admins = await client.get_participants(chat, filter=ChannelParticipantsAdmins)
-                admin_ids = [admin.id for admin in admins]
-                if USER_ID in admin_ids:
-                    sender = await client.get_entity(USER_ID)
-                    print(f"\n收到新息事件: {event}")
-                    print(f"消息类型: {type(event.message)}")
-                    print(f"来源: {event.chat if event.chat else '未知'}")
+            await send_scheduler.send('delete_message', target_chat_id, message_id=message_id)
         except Exception as e:
-            print(f"获取发送者信息失败: {str(e)}")
+            logger.error(f"同步删除时出错: {str(e)}", extra=fields(target=target_chat_id, message_id=message_id))
+
+def buffer_media_group(event):
+    """缓存相册消息，时间窗口内没有新消息时合并发送"""
+    grouped_id = event.message.grouped_id
+    if grouped_id not in message_groups:
+        asyncio.get_running_loop().call_later(GROUP_TIME_WINDOW, flush_media_group, grouped_id)
+    message_groups[grouped_id].append(event)
+    last_message_time[grouped_id] = time.monotonic()
+
+def flush_media_group(grouped_id):
+    """定时器回调：窗口内仍有新消息则顺延，否则取出整组转发"""
+    remaining = last_message_time[grouped_id] + GROUP_TIME_WINDOW - time.monotonic()
+    if remaining > 0:
+        asyncio.get_running_loop().call_later(remaining, flush_media_group, grouped_id)
+        return
+    group_events = message_groups.pop(grouped_id)
+    last_message_time.pop(grouped_id, None)
+    spawn(source_queues.put(peer_id(group_events[0].chat_id), group_events))
+
+def spawn(coro):
+    """创建后台任务并保留引用"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+def has_media(message):
+    """是否包含可以转发的媒体（网页预览不算）"""
+    return bool(message.photo or message.document)
+
+def build_input_media(media_file, caption, parse_mode):
+    """根据消息的媒体类型构建 InputMedia"""
+    message = media_file.message
+    kwargs = {'media': media_file.read()}
+    if caption:
+        kwargs['caption'] = caption
+        kwargs['parse_mode'] = parse_mode
+    if message.photo:
+        return InputMediaPhoto(**kwargs)
+    if message.video:
+        return InputMediaVideo(**kwargs)
+    if message.audio:
+        return InputMediaAudio(**kwargs)
+    return InputMediaDocument(filename=media_file.name, **kwargs)
+
+def media_send_method(media_file, caption, parse_mode):
+    """根据消息的媒体类型选择 Bot 发送方法和参数"""
+    message = media_file.message
+    data = media_file.read()
+    kwargs = {}
+    if caption:
+        kwargs['caption'] = caption
+        kwargs['parse_mode'] = parse_mode
+    if message.photo:
+        return 'send_photo', dict(photo=data, **kwargs)
+    if message.sticker:
+        return 'send_sticker', dict(sticker=data)
+    if message.gif:
+        return 'send_animation', dict(animation=data, filename=media_file.name, **kwargs)
+    if message.video_note:
+        return 'send_video_note', dict(video_note=data)
+    if message.video:
+        return 'send_video', dict(video=data, filename=media_file.name, **kwargs)
+    if message.voice:
+        return 'send_voice', dict(voice=data, **kwargs)
+    if message.audio:
+        return 'send_audio', dict(audio=data, filename=media_file.name, **kwargs)
+    return 'send_document', dict(document=data, filename=media_file.name, **kwargs)
+
+async def forward_media_message(chat, bindings, message):
+    """转发带媒体的单条消息，媒体只下载一次"""
+    if media_downloader.too_large(message):
+        logger.warning("媒体文件超过大小上限，只转发文字", extra=fields(source=chat.id, size=message.file.size))
+        await forward_caption(chat.id, bindings, message)
+        return
+    
+    targets = await format_targets(chat.id, bindings, message.text or '', media=True)
+    if not targets:
+        return
+    
+    with stage_seconds.time('download', chat.id, ''):
+        batch = await media_downloader.download(message.client, [message])
+    try:
+        media_file = batch.files[0]
+        await asyncio.gather(*(
+            send_media_to_target(binding, content, media_file, source_key(chat.id, message))
+            for binding, content in targets
+        ))
+    finally:
+        await batch.close()
+
+async def forward_caption(chat_id, bindings, message):
+    """媒体无法发送时按文字消息转发说明文字，过滤后内容为空时不发送"""
+    source = source_key(chat_id, message)
+    sends = [
+        send_to_target(binding, content, source)
+        for binding, content in await format_targets(chat_id, bindings, message.text or '')
+    ]
+    if sends:
+        message_map.track(source, await asyncio.gather(*sends))
+
+async def send_media_to_target(binding, caption, media_file, source):
+    """发送媒体到单个目标"""
+    source_format = binding.format
+    parse_mode = ParseMode.HTML if source_format.parse_mode == 'html' else ParseMode.MARKDOWN
+    method, kwargs = media_send_method(media_file, caption, parse_mode)
+    started = time.perf_counter()
+    try:
+        sent = await send_scheduler.send(method, binding.target_chat_id, **kwargs)
+        forwarded_total.inc(binding.chat_id, binding.target_chat_id, 'sent')
+        message_map.add(source, binding.target_chat_id, sent.message_id)
+    except Exception as e:
+        forwarded_total.inc(binding.chat_id, binding.target_chat_id, 'failed')
+        logger.error(f"发送媒体时出错: {str(e)}", extra=fields(source=binding.chat_id, target=binding.target_chat_id))
+    stage_seconds.observe(time.perf_counter() - started, 'send', binding.chat_id, binding.target_chat_id)
+
+async def forward_media_group(group_events):
+    """将一组相册消息过滤一次后以 send_media_group 转发到各目标"""
+    try:
+        messages = sorted((e.message for e in group_events), key=lambda m: m.id)
+        chat = await group_events[0].get_chat()
+        bindings = routing_table.get(chat.id)
+        
+        # 相册的说明文字只在其中一条消息上
+        caption = next((m.text for m in messages if m.text), '')
+        if sampled():
+            logger.info("收到相册", extra=fields(
+                source=chat.id, title=chat.title, count=len(messages), content=truncate(caption)
+            ))
+        
+        targets = await format_targets(chat.id, bindings, caption, media=True)
+        if not targets:
             return
         
+        # 每个媒体只下载一次，供所有目标共用
+        sendable = [m for m in messages if has_media(m) and not media_downloader.too_large(m)]
+        if not sendable:
+            # 媒体都无法发送时只转发说明文字
+            captioned = next((m for m in messages if m.text), None)
+            if captioned is not None:
+                logger.warning("相册媒体超过大小上限，只转发文字", extra=fields(source=chat.id))
+                await forward_caption(chat.id, bindings, captioned)
+            return
+        messages = sendable
+        with stage_seconds.time('download', chat.id, ''):
+            # 使用收到消息的账号下载
+            batch = await media_downloader.download(messages[0].client, messages)
+        try:
+            if len(batch.files) == 1:
+                # send_media_group 至少需要 2 条媒体，只剩一条时按单条媒体发送
+                media_file = batch.files[0]
+                await asyncio.gather(*(
+                    send_media_to_target(binding, content, media_file, source_key(chat.id, media_file.message))
+                    for binding, content in targets
+                ))
+            else:
+                await asyncio.gather(*(
+                    send_media_group_to_target(binding, content, batch.files, chat.id)
+                    for binding, content in targets
+                ))
+        finally:
+            await batch.close()
+    except Exception as e:
+        logger.exception(f"处理相册时出错: {str(e)}")
+
+async def send_media_group_to_target(binding, caption, files, source_chat_id):
+    """发送相册到单个目标，说明文字放在第一条媒体上"""
+    source_format = binding.format
+    parse_mode = ParseMode.HTML if source_format.parse_mode == 'html' else ParseMode.MARKDOWN
+    started = time.perf_counter()
+    try:
+        media = [
+            build_input_media(media_file, caption if i == 0 else None, parse_mode)
+            for i, media_file in enumerate(files)
+        ]
+        sent = await send_scheduler.send_media_group(binding.target_chat_id, media=media)
+        # 副本与来源消息按顺序一一对应
+        for media_file, copy in zip(files, sent):
+            message_map.add(source_key(source_chat_id, media_file.message), binding.target_chat_id, copy.message_id)
+        forwarded_total.inc(source_chat_id, binding.target_chat_id, 'sent')
+    except Exception as e:
+        forwarded_total.inc(source_chat_id, binding.target_chat_id, 'failed')
+        logger.error(f"发送相册时出错: {str(e)}", extra=fields(source=source_chat_id, target=binding.target_chat_id))
+    stage_seconds.observe(time.perf_counter() - started, 'send', source_chat_id, binding.target_chat_id)
+
+async def handle_admin_change(event):
+    """管理员或成员变化时清除该聊天的管理员缓存"""
+    if isinstance(event, events.ChatAction.Event):
+        admin_cache.invalidate(event.chat_id)
+    elif isinstance(event, types.UpdateChannelParticipant):
+        admin_cache.invalidate(event.channel_id)
+    elif isinstance(event, types.UpdateChatParticipantAdmin):
+        admin_cache.invalidate(event.chat_id)
+
+def should_handle(event):
+    """事件预过滤：只放行已绑定来源的消息和频道中的命令，在任何 await 之前执行"""
+    if routing_table.has_source(event.chat_id):
+        # 多个账号都在来源中时只由来源的接收账号处理
+        return accounts.owns(event.client, event.chat_id)
+    text = event.message.text
+    return bool(text) and text.startswith('/') and event.is_channel
+
+async def handle_edited_message(event):
+    """来源消息被编辑时更新已转发的副本"""
+    if routing_table.has_source(event.chat_id) and accounts.owns(event.client, event.chat_id):
+        buffer_edit(event)
+
+async def handle_deleted_message(event):
+    """来源消息被删除时删除已转发的副本"""
+    # 私聊和普通群组的删除事件不带聊天ID，无法对应来源，只能同步频道和超级群组
+    if event.chat_id is None or not routing_table.has_source(event.chat_id):
+        return
+    if not accounts.owns(event.client, event.chat_id):
+        return
+    chat_id = peer_id(event.chat_id)
+    for message_id in event.deleted_ids:
+        spawn(delete_copies((chat_id, message_id)))
+
+async def handle_new_message(event):
+    received = time.perf_counter()
+    # 检查消息是否已经处理过；转发的消息在处理完成后才记录，见 mark_processed
+    if message_dedup.seen((event.chat_id, event.message.id)):
+        return
+    
+    # 检查是否是命令消息
+    if event.message.text and event.message.text.startswith('/'):
+        # 于频道消息，检查发送者是否是管理员，管理员列表有缓存，命中时只需一次集合查找
         # 如果是管理员发送的命令，直接处理命令
-        if sender and sender.id == USER_ID:
+        if event.is_channel and await admin_cache.is_admin(event.client, event.chat_id, USER_ID):
+            # 多个账号收到同一条命令时只执行一次
+            if message_dedup.is_duplicate((event.chat_id, event.message.id)):
+                return
             message_text = event.message.text
+            logger.info("收到频道命令", extra=fields(chat_id=event.chat_id, command=truncate(message_text)))
             command = message_text.split()[0][1:]  # 移除 '/'
             args = message_text.split()[1:] if len(message_text.split()) > 1 else []
             
@@ -483,6 +922,7 @@ async def handle_new_message(event):
                 'regex_remove': regex_remove,
                 'preview': preview_setting,
                 'export': export_keywords,
+                'status': queue_status,
             }
             
             # 根据命令调用相应的处理函数
@@ -490,144 +930,187 @@ async def handle_new_message(event):
                 if command in command_handlers:
                     await command_handlers[command](update, context)
                 else:
-                    print(f"未知命令: {command}")
+                    logger.warning(f"未知命令: {command}")
             except Exception as e:
-                print(f"处理命令时出错: {str(e)}")
+                logger.exception(f"处理命令时出错: {str(e)}")
                 await application.bot.send_message(
                     chat_id=event.chat_id,
                     text=f"❌ 执行命令时出错: {str(e)}"
                 )
             return
+    
+    # 预过滤放行了所有频道中的命令，不是来源的频道到这里就结束
+    if not routing_table.has_source(event.chat_id):
+        return
+
+    chat_id = peer_id(event.chat_id)
+    events_total.inc(chat_id)
+    held = catching_up.get(chat_id)
+    if held is not None:
+        held.append(event)
+        return
+    await enqueue_event(event)
+    stage_seconds.observe(time.perf_counter() - received, 'receive', chat_id, '')
+
+async def enqueue_event(event):
+    # 相册消息先缓存，时间窗口结束后合并转发
+    if event.message.grouped_id:
+        buffer_media_group(event)
+        return
+    
+    # 普通消息放入来源队列，由工作协程完成转发
+    await source_queues.put(peer_id(event.chat_id), event)
+
+class HistoryEvent:
+    """补发的历史消息，提供转发流程用到的事件属性"""
+    def __init__(self, message):
+        self.message = message
+        self.chat_id = message.chat_id
+    
+    async def get_chat(self):
+        return await self.message.get_chat()
+
+async def feed_history(chat_id, messages):
+    """把补发的消息按顺序放入来源队列，之后放入补发期间收到的实时消息"""
+    try:
+        album = []
+        for message in messages:
+            # 服务消息和命令不补发
+            if getattr(message, 'action', None) or (message.text or '').startswith('/'):
+                continue
+            if message_dedup.seen((message.chat_id, message.id)):
+                continue
+            event = HistoryEvent(message)
+            # 历史消息中相册是连续的，直接合并，不经过时间窗口
+            if album and album[0].message.grouped_id != message.grouped_id:
+                await source_queues.put(chat_id, album, block=True)
+                album = []
+            if message.grouped_id:
+                album.append(event)
+            else:
+                await source_queues.put(chat_id, event, block=True)
+        if album:
+            await source_queues.put(chat_id, album, block=True)
+    finally:
+        for event in catching_up.pop(chat_id, []):
+            await enqueue_event(event)
+
+async def process_item(item):
+    """来源队列的工作协程：列表为相册，否则为单条消息或编辑"""
+    if isinstance(item, MessageEdit):
+        # 等待副本发送完成可能需要较长时间，不占用来源队列
+        spawn(sync_edit(item.event))
+        return
+    group = unprocessed(item if isinstance(item, list) else [item])
+    if not group:
+        return
+    if isinstance(item, list):
+        await forward_media_group(group)
+    else:
+        await forward_event(item)
+    mark_processed(group)
+
+def unprocessed(events):
+    """去掉已处理过的和重复的消息：多个账号收到的同一条消息、补发与实时消息的重复在处理时过滤"""
+    keys = set()
+    result = []
+    for event in events:
+        key = (event.chat_id, event.message.id)
+        if key not in keys and not message_dedup.seen(key):
+            keys.add(key)
+            result.append(event)
+    return result
+
+def mark_processed(item):
+    """记录来源消息已处理：加入去重窗口，推进补发位置
+
+    两者都在处理完成后记录，排队中未处理的消息重启后仍会补发。
+    """
+    group = item if isinstance(item, list) else [item]
+    for event in group:
+        message_dedup.add((event.chat_id, event.message.id))
+    checkpoints.mark(peer_id(group[0].chat_id), max(event.message.id for event in group))
 
-    # 处理普通消息的转发逻辑...
-    session = Session()
+async def spill_event(item):
+    """队列溢出时直接过滤格式化并写入发件箱，相册、媒体和编辑无法写入，返回 False"""
+    if isinstance(item, (list, MessageEdit)) or has_media(item.message):
+        return False
+    chat_id = peer_id(item.chat_id)
+    for binding, content in await format_targets(chat_id, routing_table.get(chat_id), item.message.text or ''):
+        await outbox.spill(binding.target_chat_id, build_send_kwargs(binding, content))
+    mark_processed(item)
+    return True
+
+source_queues = SourceQueues(
+    process_item,
+    workers=SOURCE_WORKERS,
+    maxsize=SOURCE_QUEUE_SIZE,
+    overflow=SOURCE_QUEUE_OVERFLOW,
+    spill=spill_event
+)
+
+# 队列深度在抓取指标时读取
+Gauge('forwarder_source_queue_depth', '来源队列中等待处理的消息数', ('source',),
+      collect=lambda: {(chat_id,): depth for chat_id, depth in source_queues.depths().items()})
+Gauge('forwarder_send_queue_depth', '发送调度器中等待发送的消息数', ('target',),
+      collect=lambda: {(chat_id,): depth for chat_id, depth in send_scheduler.pending().items()})
+
+async def forward_event(event):
+    """过滤、格式化并转发单条消息"""
     try:
-        # 获取聊天信���
+        started = time.perf_counter()
+        # 获取聊天信息
         chat = await event.get_chat()
         
-        # 取消息来源和查询
-        sources = session.query(Source).filter(
-            Source.chat_id == str(chat.id)
-        ).all()
+        # 从内存路由表获取绑定
+        bindings = routing_table.get(chat.id)
+        stage_seconds.observe(time.perf_counter() - started, 'lookup', chat.id, '')
+        
+        if not bindings:
+            return
+        source = source_key(chat.id, event.message)
         
-        if not sources:
+        # 带媒体的消息下载一次后转发到各目标
+        if has_media(event.message):
+            await forward_media_message(chat, bindings, event.message)
             return
         
         # 获取消息文本
         message_text = event.message.text if event.message.text else ''
         
-        # 对每个目标都进行转发
-        for source in sources:
-            # 打印消息信息
-            print(f"\n收到消息 - 来自: {chat.title or chat.id} ({chat.id})")
-            print(f"📝 消息内容: {message_text[:50]}{'...' if len(message_text) > 50 else ''}")
-            print(f"⚙️ 当前模式: {'白名单' if source.filter_mode == 'whitelist' else '黑名单'}")
-            
-            # 检查关键词匹配
-            keywords = session.query(Keyword).filter(
-                Keyword.target_chat_id == source.target_chat_id
-            ).all()
-            
-            # 将消息内容转换为小写进行匹配
-            message_text_lower = message_text.lower()
-            
-            # 检查是否匹配任何关键词
-            matched = False
-            for keyword in keywords:
-                if keyword.word in message_text_lower:  # 使用小写内容进行匹配
-                    matched = True
-                    break
-            
-            # 据过滤模式决定是否转发
-            should_forward = (
-                (source.filter_mode == 'whitelist' and matched) or
-                (source.filter_mode == 'blacklist' and not matched)
-            )
-            
-            if should_forward:
-                try:
-                    content = message_text
-                    # 获取预览置
-                    preview_setting = session.query(PreviewSetting).filter(
-                        PreviewSetting.chat_id == str(chat.id)
-                    ).first()
-                    # 默认关闭预览，除非明确设置开启
-                    disable_preview = not (preview_setting and preview_setting.enable_preview)
-                    
-                    # 获取消息格式设置
-                    format_setting = session.query(MessageFormat).filter(
-                        MessageFormat.chat_id == str(chat.id)
-                    ).first()
-                    
-                    # 获取正则格式设置
-                    regex_formats = session.query(RegexFormat).filter(
-                        RegexFormat.chat_id == str(chat.id)
-                    ).all()
-                    
-                    # 检查正则匹配并处理内容
-                    parse_mode = 'markdown'  # 默认格式
-                    if regex_formats:
-                        import re
-                        for regex_format in regex_formats:
-                            try:
-                                pattern = regex_format.pattern
-                                # 不再对模式进行转义
-                                # 使用正则表达式替换内容，保留链接部分
-                                if '[' in content and '](' in content:
-                                    # 处理带链接的文本
-                                    parts = content.split('](')
-                                    text_part = parts[0][1:]  # 移除开头的 [
-                                    link_part = parts[1]  # 包含链接和可能的其他文本
-                                    
-                                    # 只处理文本部分
-                                    text_part = re.sub(pattern, '', text_part)
-                                    content = f'[{text_part}]({link_part}'
-                                else:
-                                    # 处理普通文本
-                                    content = re.sub(pattern, '', content)
-                                    
-                                parse_mode = regex_format.parse_mode
-                                # 打印调试信息
-                                print(f"匹配到正则表达式: {pattern}")
-                                print(f"处理后的内容: {content}")
-                                print(f"使用格式: {parse_mode}")
-                            except re.error as e:
-                                print(f"正则表达式错误: {str(e)}")
-                                continue
-                    else:
-                        # 如果没有则规则，使用默认格式设置
-                        parse_mode = format_setting.parse_mode if format_setting else 'markdown'
-                    
-                    # 只有当内容不为空时才发送消息
-                    if content.strip():
-                        await application.bot.send_message(
-                            chat_id=source.target_chat_id,
-                            text=content,
-                            parse_mode=ParseMode.HTML if parse_mode == 'html' else ParseMode.MARKDOWN,
-                            disable_web_page_preview=disable_preview
-                        )
-                except Exception as e:
-                    print(f"发送消息时出错: {str(e)}")
+        # 对每个目标都进行过滤和格式化，然后并发写入发件箱
+        # 每条消息都会经过这里，非调试模式下按比例采样记录
+        if sampled():
+            logger.info("收到消息", extra=fields(
+                source=chat.id, title=chat.title, message_id=event.message.id,
+                targets=len(bindings), content=truncate(message_text)
+            ))
+        sends = []
+        for binding, content in await format_targets(chat.id, bindings, message_text):
+            sends.append(send_to_target(binding, content, source))
+        
+        if sends:
+            message_map.track(source, await asyncio.gather(*sends))
     
     except Exception as e:
-        print(f"处理消息时出错: {str(e)}")
-    finally:
-        session.close()
+        logger.exception(f"处理消息时出错: {str(e)}")
 
-async def start_client():
-    print("正在启动 Telethon 客户端...")
+async def start_client(account):
+    client = account.client
+    logger.info("正在启动 Telethon 客户端", extra=fields(account=account.name))
     try:
         # 连接到 Telegram
         await client.connect()
         
-        # 如果还没有权限，则开交互式登录
+        # 如果还没有权限，则开交互式登录，提示和输入直接使用终端
         if not await client.is_user_authorized():
-            print("\n需进行 Telegram 账号验证")
-            phone = os.getenv('PHONE_NUMBER')
+            print(f"\n需进行 Telegram 账号验证 ({account.name})")
+            # 环境变量中的手机号只用于主账号
+            phone = os.getenv('PHONE_NUMBER') if account is accounts.primary else None
             if not phone:
                 phone = input("请输入您的 Telegram 手机号 (格式如: +86123456789): ")
             else:
-                print(f"使用环境变量中的手机号: {phone}")
+                logger.info("使用环境变量中的手机号", extra=fields(account=account.name))
             
             # 发送验证码
             await client.send_code_request(phone)
@@ -642,10 +1125,11 @@ async def start_client():
                 password = input("\n请输入您的两步验证密码: ")
                 await client.sign_in(password=password)
         
-        print("\nTelethon 客户端登录成！")
+        logger.info("Telethon 客户端登录成功", extra=fields(account=account.name))
+        account.active = True
         
     except Exception as e:
-        print(f"\n登录过程出现错误: {str(e)}")
+        logger.error(f"登录过程出现错误: {str(e)}", extra=fields(account=account.name))
         raise e
 
 async def send_startup_message():
@@ -660,30 +1144,91 @@ async def send_startup_message():
         "3. /add <关键字> - 添加当前窗口的过滤关键字\n"
         "4. /remove <关键字> - 删除当前窗口的过滤关键字\n"
         "5. /list - 查看当前窗口的配置信息\n"
-        "6. /export - 导出当前窗口的关键字列表\n"
+        "6. /export - 导出当前窗口的关键字列表（/import 回复文件可批量导入）\n"
         "7. /switch <来源ID或链接> <格式> - 设置指定来源的消息格式(html/markdown)\n"
-        "8. /regex <来源ID或链接> <正则表达式> [格式] - 设置正则表达式消息格式\n"
+        "8. /regex <来源ID或链接> <正则表达式> [格式] - 添加正则表达式规则（可添加多条，按顺序应用）\n"
         "9. /regex_list <来源ID或链接> - 查看正则表达式规则\n"
-        "10. /regex_remove <来源ID或链接> - 移除正则表达式规则\n"
-        "11. /preview <来源ID或链接> <on/off> - 设置链接预览开关\n\n"
+        "10. /regex_remove <来源ID或链接> [序号] - 移除正则表达式规则\n"
+        "11. /preview <来源ID或链接> <on/off> - 设置链接预览开关\n"
+        "12. /status - 查看转发队列状态\n\n"
         "🤖 机器人已准备就绪！"
         )
     except Exception as e:
-        print(f"发送启动消息失败: {str(e)}")
+        logger.error(f"发送启动消息失败: {str(e)}")
 
 async def setup_and_run():
     """设置并运行所有组件"""
+    drain_task = None
+    dedup_task = None
+    checkpoint_task = None
+    catchup_task = None
+    metrics_server = None
     try:
-        # Start Telethon client with authentication
-        await start_client()
+        # 初始化数据库并加载路由表
+        await init_db()
+        await routing_table.load()
+        await accounts.load()
+        
+        # 分片工作进程各自从数据库加载负责的来源，命令修改配置后通知重新加载
+        if shard_pool is not None:
+            await shard_pool.start()
+            routing_table.listeners.append(shard_pool.reload)
+            logger.info(f"已启动 {SHARDS} 个分片工作进程")
+        
+        # 有补发位置的来源在补发完成前暂存实时消息，需在注册事件处理器之前设置
+        missed = await checkpoints.load() if CATCHUP else {}
+        for chat_id in missed:
+            catching_up[chat_id] = []
         
-        # 处理消息处理器，同时处理频道消息
-        client.add_event_handler(handle_new_message, events.NewMessage())
-        client.add_event_handler(handle_new_message, events.MessageEdited())  # 可选：处理编辑的消息
+        # Start Telethon client with authentication
+        # 主账号登录失败时无法启动，其他账号失败时跳过，它负责的来源由其他账号接收
+        for account in accounts:
+            try:
+                await start_client(account)
+            except Exception:
+                if account is accounts.primary:
+                    raise
+                logger.error("账号登录失败，跳过", extra=fields(account=account.name))
         
         # 启动 bot
         await application.initialize()
         await application.start()
+        send_scheduler.start(application.bot)
+        
+        source_queues.start()
+        
+        # 处理消息处理器，同时处理频道消息；所有账号的事件进入同一个转发流程
+        # 在发送调度和来源队列启动之后注册，收到的第一条消息就能入队处理
+        for account in accounts.active():
+            account.client.add_event_handler(handle_new_message, events.NewMessage(func=should_handle))
+            account.client.add_event_handler(handle_edited_message, events.MessageEdited())
+            if PROPAGATE_DELETES:
+                account.client.add_event_handler(handle_deleted_message, events.MessageDeleted())
+            account.client.add_event_handler(handle_admin_change, events.ChatAction())
+            account.client.add_event_handler(handle_admin_change, events.Raw((types.UpdateChannelParticipant, types.UpdateChatParticipantAdmin)))
+        
+        if METRICS_PORT:
+            metrics_server = await serve_metrics(METRICS_HOST, int(METRICS_PORT))
+            logger.info(f"指标服务已启动: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+        
+        # 重放上次未完成的转发任务，之后继续发送队列溢出写入的任务
+        backlog = await outbox.backlog()
+        if backlog:
+            logger.info(f"重放 {backlog} 条未完成的转发任务")
+        drain_task = asyncio.create_task(drain_outbox())
+        dedup_task = asyncio.create_task(message_dedup.autosave())
+        checkpoint_task = asyncio.create_task(checkpoints.autosave())
+        
+        # 补发停机期间的消息，与实时消息共用来源队列和转发流程
+        # 每个账号补发自己接收的来源
+        if missed:
+            by_account = defaultdict(dict)
+            for chat_id, checkpoint in missed.items():
+                by_account[accounts.receiver(chat_id)][chat_id] = checkpoint
+            catchup_task = asyncio.gather(*(
+                catch_up(account.client, chats, feed_history, limit=CATCHUP_LIMIT, concurrency=CATCHUP_CONCURRENCY)
+                for account, chats in by_account.items()
+            ))
         
         # 设置 bot 命令
         commands = [
@@ -694,8 +1239,10 @@ async def setup_and_run():
             ("remove", "删除过滤关键字"),
             ("list", "查看当前配置信息"),
             ("export", "导出当前窗口的关键字列表"),
+            ("import", "从文件批量导入关键字"),
             ("switch", "设置指定来源的消息格式"),
-            ("regex", "设置正则表达式消息格式")  # 添加 regex 命令说明
+            ("regex", "设置正则表达式消息格式"),  # 添加 regex 命令说明
+            ("status", "查看转发队列状态")
         ]
         
         await application.bot.set_my_commands(commands)
@@ -710,148 +1257,160 @@ async def setup_and_run():
                 drop_pending_updates=True
             )
         )
-        client_task = asyncio.create_task(client.run_until_disconnected())
+        client_tasks = [asyncio.create_task(account.client.run_until_disconnected()) for account in accounts.active()]
 
         # 等待所有任务完成或直到被中断
         try:
-            await asyncio.gather(polling_task, client_task)
+            await asyncio.gather(polling_task, *client_tasks)
         except asyncio.CancelledError:
             # 处理取消
-            print("\n正在关闭服务...")
+            logger.info("正在关闭服务...")
         finally:
             # 取消所有未完成的任务
             polling_task.cancel()
-            client_task.cancel()
+            for task in client_tasks:
+                task.cancel()
             try:
                 await polling_task
             except asyncio.CancelledError:
                 pass
-            try:
-                await client_task
-            except asyncio.CancelledError:
-                pass
+            await asyncio.gather(*client_tasks, return_exceptions=True)
         
     except Exception as e:
-        print(f"运行时出错: {str(e)}")
+        logger.exception(f"运行时出错: {str(e)}")
         raise e
     finally:
         # 确保正确关闭
+        if drain_task is not None:
+            drain_task.cancel()
+        for task in (dedup_task, checkpoint_task, catchup_task):
+            if task is not None:
+                task.cancel()
+        if metrics_server is not None:
+            metrics_server.close()
+        # 先停止来源队列，之后保存的去重记录只包含已处理完的消息
+        await source_queues.stop()
+        await message_dedup.save()
+        if shard_pool is not None:
+            await shard_pool.stop()
+        await send_scheduler.stop()
+        await outbox.close()
+        await message_map.close()
+        await checkpoints.save()
+        await engine.dispose()
         await application.stop()
-        await client.disconnect()
+        for account in accounts:
+            await account.client.disconnect()
+
+async def queue_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """显示转发队列状态"""
+    if update.effective_user.id != USER_ID:
+        return
+    
+    depths = source_queues.depths()
+    pending = send_scheduler.pending()
+    loads = accounts.loads()
+    lines = [
+        "📊 队列状态：",
+        f"\n📥 来源队列: {sum(depths.values())} 条 ({len(depths)} 个来源)",
+        *[f"- {chat_id}: {depth}" for chat_id, depth in sorted(depths.items(), key=lambda x: -x[1])[:10]],
+        f"\n📤 发送队列: {sum(pending.values())} 条 ({len(pending)} 个目标)",
+        *[f"- {chat_id}: {depth}" for chat_id, depth in sorted(pending.items(), key=lambda x: -x[1])[:10]],
+        f"\n💾 发件箱积压: {await outbox.backlog()} 条",
+        *([f"🧩 分片工作进程: {shard_pool.alive()}/{SHARDS} 个运行中，已重启 {shard_pool.restarts} 次"] if shard_pool is not None else []),
+        f"⚠️ 队列满时处理方式: {source_queues.overflow}",
+        f"🗑 已丢弃: {source_queues.dropped} 条",
+        f"💾 已溢出写入发件箱: {source_queues.spilled} 条",
+        *(["\n👤 接收账号:", *[
+            f"- {account.name}: {loads[account.name]} 个来源{'' if account.active else ' (未登录)'}"
+            for account in accounts
+        ]] if len(accounts) > 1 else []),
+        f"\n🔁 重试次数: {sum(retry_counters.values())}",
+        *[f"- {name} ({reason}): {count}" for (name, reason), count in sorted(retry_counters.items())]
+    ]
+    await update.message.reply_text("\n".join(lines))
 
 async def list_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """显示当前聊天窗口的配置信息和键字列表"""
     if update.effective_user.id != USER_ID:
         return
     
-    session = Session()
-    try:
-        # 获取当前聊天窗口ID
-        current_chat_id = str(update.effective_chat.id)
-        
+    # 获取当前聊天窗口ID
+    current_chat_id = update.effective_chat.id
+    
+    async with Session() as session:
         # 检查当前窗口绑定信息
-        sources_as_target = session.query(Source).filter(
-            Source.target_chat_id == current_chat_id
-        ).all()
-        
-        sources_as_source = session.query(Source).filter(
-            Source.chat_id == current_chat_id
-        ).all()
-        
-        if sources_as_target:
-            # 如果是目标窗口，显示所有来源
-            source_info = []
-            for source in sources_as_target:
-                try:
-                    chat = await client.get_entity(int(source.chat_id))
-                    source_info.append(
-                        f"- {chat.title} ({source.chat_id}) "
-                        f"[{'白名单' if source.filter_mode == 'whitelist' else '黑名单'}]"
-                    )
-                except:
-                    source_info.append(
-                        f"- {source.chat_id} "
-                        f"[{'白名单' if source.filter_mode == 'whitelist' else '黑名单'}]"
-                    )
-            
-            info_text = [
-                "📋 当前配置信息：",
-                "\n📤 来源窗口:",
-                *source_info,
-                "\n📝 关键词列表："
-            ]
-            
-            # 获取关键词列表
-            keywords = session.query(Keyword).filter(
-                Keyword.target_chat_id == current_chat_id
-            ).all()
-            
-        elif sources_as_source:
-            # 如果是来源窗口，显示所有目标
-            target_info = []
-            for source in sources_as_source:
-                try:
-                    chat = await client.get_entity(int(source.target_chat_id))
-                    target_info.append(
-                        f"- {chat.title} ({source.target_chat_id}) "
-                        f"[{'白名单' if source.filter_mode == 'whitelist' else '黑名单'}]"
-                    )
-                except:
-                    target_info.append(
-                        f"- {source.target_chat_id} "
-                        f"[{'白名单' if source.filter_mode == 'whitelist' else '黑名单'}]"
-                    )
-            
-            info_text = [
-                "当前配置信息：",
-                "\n📥 转发至:",
-                *target_info
-            ]
-            
-            # 不显示关词列表，因为关键词是按目标窗口存储的
-            keywords = []
-        else:
-            await update.message.reply_text("当前窗口未配置任何转发规则")
-            return
+        sources_as_target = (await session.scalars(
+            select(Source).where(Source.target_chat_id == current_chat_id)
+        )).all()
+        
+        sources_as_source = (await session.scalars(
+            select(Source).where(Source.chat_id == peer_id(current_chat_id))
+        )).all()
+        
+        # 只有目标窗口显示关键词列表，因为关键词是按目标窗口存储的
+        keywords = (await session.scalars(
+            select(Keyword).where(Keyword.target_chat_id == current_chat_id)
+        )).all() if sources_as_target else []
+    
+    if sources_as_target:
+        # 如果是目标窗口，显示所有来源
+        info_text = [
+            "📋 当前配置信息：",
+            "\n📤 来源窗口:",
+            *await describe_bindings(sources_as_target, 'chat_id'),
+            "\n📝 关键词列表："
+        ]
         
-        # 显示关键词列表
-        if keywords:
-            total_pages = ceil(len(keywords) / 50)
-            current_keywords = keywords[:50]
-            info_text.extend([f"{i+1}. {kw.word}" for i, kw in enumerate(current_keywords)])
-            if total_pages > 1:
-                info_text.append(f"\n页码: 1/{total_pages}")
-                keyboard = [[InlineKeyboardButton("️下一页", callback_data="list_keywords_1")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-            else:
-                reply_markup = None
+    elif sources_as_source:
+        # 如果是来源窗口，显示所有目标
+        info_text = [
+            "当前配置信息：",
+            "\n📥 转发至:",
+            *await describe_bindings(sources_as_source, 'target_chat_id')
+        ]
+    else:
+        await update.message.reply_text("当前窗口未配置任何转发规则")
+        return
+    
+    # 显示关键词列表
+    if keywords:
+        total_pages = ceil(len(keywords) / 50)
+        current_keywords = keywords[:50]
+        info_text.extend([f"{i+1}. {kw.word}" for i, kw in enumerate(current_keywords)])
+        if total_pages > 1:
+            info_text.append(f"\n页码: 1/{total_pages}")
+            keyboard = [[InlineKeyboardButton("️下一页", callback_data="list_keywords_1")]]
+            reply_markup = InlineKeyboardMarkup(keyboard)
         else:
-            info_text.append("暂无关键字")
             reply_markup = None
-        
-        await update.message.reply_text(
-            "\n".join(info_text),
-            reply_markup=reply_markup
-        )
+    else:
+        info_text.append("暂无关键字")
+        reply_markup = None
     
-    finally:
-        session.close()
+    await update.message.reply_text(
+        "\n".join(info_text),
+        reply_markup=reply_markup
+    )
 
 async def handle_list_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理关键词列表分页"""
     query = update.callback_query
     await query.answer()
     
-    session = Session()
     try:
         if query.data.startswith("list_keywords_"):
             page = int(query.data.split("_")[-1])
-            current_chat_id = str(query.message.chat_id)
+            current_chat_id = query.message.chat_id
             
-            # 获取当前窗口的关键字
-            keywords = session.query(Keyword).filter(
-                Keyword.target_chat_id == current_chat_id
-            ).all()
+            async with Session() as session:
+                # 获取当前窗口的关键字和来源信息
+                keywords = (await session.scalars(
+                    select(Keyword).where(Keyword.target_chat_id == current_chat_id)
+                )).all()
+                sources = (await session.scalars(
+                    select(Source).where(Source.target_chat_id == current_chat_id)
+                )).all()
             
             total_pages = ceil(len(keywords) / 50)
             
@@ -863,32 +1422,13 @@ async def handle_list_callback(update: Update, context: ContextTypes.DEFAULT_TYP
             end_idx = start_idx + 50
             current_keywords = keywords[start_idx:end_idx]
             
-            # 获取来源信息
-            sources = session.query(Source).filter(
-                Source.target_chat_id == current_chat_id
-            ).all()
-            
             # 构建消息文本
             if page == 0:
                 # 第一页显示完整信息
-                source_info = []
-                for source in sources:
-                    try:
-                        chat = await client.get_entity(int(source.chat_id))
-                        source_info.append(
-                            f"- {chat.title} ({source.chat_id}) "
-                            f"[{'白名单' if source.filter_mode == 'whitelist' else '黑名单'}]"
-                        )
-                    except:
-                        source_info.append(
-                            f"- {source.chat_id} "
-                            f"[{'白名单' if source.filter_mode == 'whitelist' else '黑名单'}]"
-                        )
-                
                 text_lines = [
                     "📋 当前配置信息：",
                     "\n📤 来源窗口:",
-                    *source_info,
+                    *await describe_bindings(sources, 'chat_id'),
                     "\n📝 关键词列表："
                 ]
             else:
@@ -913,62 +1453,111 @@ async def handle_list_callback(update: Update, context: ContextTypes.DEFAULT_TYP
             )
     
     except Exception as e:
-        print(f"处理分页时出错: {str(e)}")
+        logger.exception(f"处理分页时出错: {str(e)}")
         await query.edit_message_text(f"❌ 处理分页时出错: {str(e)}")
-    finally:
-        session.close()
 
 async def export_keywords(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """导出当前窗口的所有关键字到文本文件"""
     if update.effective_user.id != USER_ID:
         return
     
-    session = Session()
+    current_chat_id = update.effective_chat.id
+    
     try:
-        current_chat_id = str(update.effective_chat.id)
-        
-        # 检查当前窗口是否是目标窗口
-        is_target = session.query(Source).filter(
-            Source.target_chat_id == current_chat_id
-        ).first() is not None
-        
-        if not is_target:
-            await update.message.reply_text("❌ 只能导出目标窗的关键字")
-            return
-        
-        # 获取当前窗口的所有关键字
-        keywords = session.query(Keyword).filter(
-            Keyword.target_chat_id == current_chat_id
-        ).all()
-        
-        if not keywords:
+        async with Session() as session:
+            # 检查当前窗口是否是目标窗口
+            if not await is_target_chat(session, current_chat_id):
+                await update.message.reply_text("❌ 只能导出目标窗的关键字")
+                return
+            
+            # 使用服务端游标分批读取关键字，直接写入内存缓冲区，用空格分隔
+            buffer = io.BytesIO()
+            result = await session.stream(
+                select(Keyword.word)
+                .where(Keyword.target_chat_id == current_chat_id)
+                .order_by(Keyword.id)
+                .execution_options(yield_per=5000)
+            )
+            count = 0
+            async for partition in result.partitions():
+                if count:
+                    buffer.write(b" ")
+                buffer.write(" ".join(word for (word,) in partition).encode('utf-8'))
+                count += len(partition)
+        
+        if not count:
             await update.message.reply_text("❌ 当前窗口没有任何关键字")
             return
         
-        # 创建临时文件
-        temp_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'temp')
-        os.makedirs(temp_dir, exist_ok=True)
-        temp_file = os.path.join(temp_dir, f'keywords_{current_chat_id}.txt')
-        
-        # 将关键字写入文件，用空格分隔
-        with open(temp_file, 'w', encoding='utf-8') as f:
-            keywords_text = " ".join(kw.word for kw in keywords)
-            f.write(keywords_text)
-        
         # 发送文件
+        buffer.seek(0)
         await update.message.reply_document(
-            document=open(temp_file, 'rb'),
+            document=buffer,
             filename=f'keywords_{current_chat_id}.txt',
-            caption="✅ 关键字导出成功"
+            caption=f"✅ 关键字导出成功，共 {count} 个"
         )
         
-        # 删除临时文件
-        os.remove(temp_file)
-        
     except Exception as e:
         await update.message.reply_text(f"❌ 导出失败: {str(e)}")
-    finally:
-        session.close()
+
+async def import_keywords(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """从上传的文本/CSV文件批量导入当前窗口的关键字"""
+    if update.effective_user.id != USER_ID:
+        return
+    
+    # 支持带 /import 说明的文件，或回复一个文件发送 /import
+    message = update.message
+    document = message.document or (message.reply_to_message and message.reply_to_message.document)
+    if not document:
+        await message.reply_text("请发送关键字文件并附带说明 /import，或回复一个关键字文件发送 /import")
+        return
+    
+    current_chat_id = update.effective_chat.id
+    
+    try:
+        # 检查当前窗口是否是目标窗口
+        async with Session() as session:
+            filter_mode = await session.scalar(
+                select(Source.filter_mode).where(Source.target_chat_id == current_chat_id).limit(1)
+            )
+        
+        if not filter_mode:
+            await message.reply_text("❌ 只能在目标窗口中管理关键字")
+            return
+        
+        file = await context.bot.get_file(document.file_id)
+        data = await file.download_as_bytearray()
+        
+        # 关键字以空白、逗号或分号分隔，转换为小写并去重
+        words = list(dict.fromkeys(
+            word.lower()
+            for word in re.split(r'[\s,;]+', data.decode('utf-8-sig', errors='ignore'))
+            if word
+        ))
+        if not words:
+            await message.reply_text("❌ 文件中没有关键字")
+            return
+        
+        count_keywords = select(func.count()).select_from(Keyword).where(Keyword.target_chat_id == current_chat_id)
+        async with write_session() as session:
+            before = await session.scalar(count_keywords)
+            # 一条语句批量插入，已存在的关键字由唯一约束跳过
+            is_whitelist = filter_mode == 'whitelist'
+            await session.execute(
+                insert_ignore(Keyword),
+                [{'target_chat_id': current_chat_id, 'word': word, 'is_whitelist': is_whitelist} for word in words]
+            )
+            added = await session.scalar(count_keywords) - before
+        routing_table.add_keywords(current_chat_id, words)
+        
+        await message.reply_text(
+            f"✅ 关键字导入完成\n"
+            f"📝 新增: {added}\n"
+            f"⚠️ 已存在: {len(words) - added}"
+        )
+    
+    except Exception as e:
+        await message.reply_text(f"❌ 导入失败: {str(e)}")
 
 async def switch_format(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """切换来源的消息解析格式"""
@@ -986,42 +1575,29 @@ async def switch_format(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ 格式必须是 html 或 markdown")
         return
     
-    session = Session()
     try:
-        # 处理链接格式
-        if 'https://t.me/' in source:
-            try:
-                chat = await client.get_entity(source)
-                chat_id = str(chat.id)
-                source_title = chat.title
-            except Exception as e:
-                await update.message.reply_text(f"❌ 获取聊天信息失败: {str(e)}")
-                return
-        else:
-            chat_id = source
-            try:
-                chat = await client.get_entity(int(chat_id))
-                source_title = chat.title
-            except:
-                source_title = chat_id
-        
-        # 更新或创建式设置
-        format_setting = session.query(MessageFormat).filter(
-            MessageFormat.chat_id == chat_id
-        ).first()
-        
-        if format_setting:
-            format_setting.parse_mode = parse_mode
-            action = "更新"
-        else:
-            format_setting = MessageFormat(
-                chat_id=chat_id,
-                parse_mode=parse_mode
+        resolved = await resolve_source(update, source)
+        if resolved is None:
+            return
+        chat_id, source_title = resolved
+        
+        async with write_session() as session:
+            # 更新或创建式设置
+            format_setting = await session.scalar(
+                select(MessageFormat).where(MessageFormat.chat_id == chat_id)
             )
-            session.add(format_setting)
-            action = "设置"
+            
+            if format_setting:
+                format_setting.parse_mode = parse_mode
+                action = "更新"
+            else:
+                session.add(MessageFormat(
+                    chat_id=chat_id,
+                    parse_mode=parse_mode
+                ))
+                action = "设置"
         
-        session.commit()
+        routing_table.set_parse_mode(chat_id, parse_mode)
         
         await update.message.reply_text(
             f"✅ 已{action}消息格式\n"
@@ -1031,11 +1607,21 @@ async def switch_format(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     except Exception as e:
         await update.message.reply_text(f"❌ 设置失败: {str(e)}")
-    finally:
-        session.close()
+
+async def get_regex_rules(session, chat_id):
+    """按应用顺序获取来源的正则规则"""
+    return (await session.scalars(
+        select(RegexFormat)
+        .where(RegexFormat.chat_id == chat_id)
+        .order_by(RegexFormat.position, RegexFormat.id)
+    )).all()
+
+async def regex_rule_list(session, chat_id):
+    """来源的正则规则 [(pattern, parse_mode)]，用于更新路由表"""
+    return [(rule.pattern, rule.parse_mode) for rule in await get_regex_rules(session, chat_id)]
 
 async def regex_format(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """设置指定来源的正则表达式消息格式"""
+    """为指定来源添加一条正则表达式规则"""
     if update.effective_user.id != USER_ID:
         return
     
@@ -1063,55 +1649,34 @@ async def regex_format(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ 格式必须是 html 或 markdown")
         return
     
-    session = Session()
     try:
-        # 处理链接格式
-        if 'https://t.me/' in source:
-            try:
-                chat = await client.get_entity(source)
-                chat_id = str(chat.id)
-                source_title = chat.title
-            except Exception as e:
-                await update.message.reply_text(f"❌ 获取聊天信息失败: {str(e)}")
-                return
-        else:
-            chat_id = source
-            try:
-                chat = await client.get_entity(int(chat_id))
-                source_title = chat.title
-            except:
-                source_title = chat_id
+        resolved = await resolve_source(update, source)
+        if resolved is None:
+            return
+        chat_id, source_title = resolved
         
         # 验证正表达式是否有效
         try:
-            import re
             re.compile(pattern)
         except re.error:
             await update.message.reply_text("❌ 无效的正则表达式")
             return
         
-        # 更新或创建正则格式设置
-        regex_format = session.query(RegexFormat).filter(
-            RegexFormat.chat_id == chat_id
-        ).first()
-        
-        if regex_format:
-            regex_format.pattern = pattern
-            regex_format.parse_mode = parse_mode
-            action = "更新"
-        else:
-            regex_format = RegexFormat(
+        async with write_session() as session:
+            # 追加到来源规则列表末尾
+            rules = await get_regex_rules(session, chat_id)
+            session.add(RegexFormat(
                 chat_id=chat_id,
                 pattern=pattern,
-                parse_mode=parse_mode
-            )
-            session.add(regex_format)
-            action = "添加"
-        
-        session.commit()
+                parse_mode=parse_mode,
+                position=rules[-1].position + 1 if rules else 0
+            ))
+            rules = await regex_rule_list(session, chat_id)
+        # 规则变化后重新编译来源的正则规则
+        routing_table.set_regex_rules(chat_id, rules)
         
         await update.message.reply_text(
-            f"✅ 已{action}正则格式规则\n"
+            f"✅ 已添加正则格式规则 #{len(rules)}\n"
             f"📤 来源: {source_title} ({chat_id})\n"
             f"📝 正则: {pattern}\n"
             f"📝 格式: {parse_mode}"
@@ -1119,8 +1684,6 @@ async def regex_format(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     except Exception as e:
         await update.message.reply_text(f"❌ 设置失败: {str(e)}")
-    finally:
-        session.close()
 
 async def regex_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """列出指定来源的正则表达式规则"""
@@ -1132,44 +1695,30 @@ async def regex_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     source = context.args[0]
-    session = Session()
     try:
-        # 处理链接格式
-        if 'https://t.me/' in source:
-            try:
-                chat = await client.get_entity(source)
-                chat_id = str(chat.id)
-                source_title = chat.title
-            except Exception as e:
-                await update.message.reply_text(f"❌ 获取聊天信息失败: {str(e)}")
-                return
-        else:
-            chat_id = source
-            try:
-                chat = await client.get_entity(int(chat_id))
-                source_title = chat.title
-            except:
-                source_title = chat_id
+        resolved = await resolve_source(update, source)
+        if resolved is None:
+            return
+        chat_id, source_title = resolved
         
         # 查询正则格式设置
-        regex_format = session.query(RegexFormat).filter(
-            RegexFormat.chat_id == chat_id
-        ).first()
+        async with Session() as session:
+            rules = await get_regex_rules(session, chat_id)
         
-        if regex_format:
+        if rules:
             await update.message.reply_text(
-                f"📋 正则格式则\n"
-                f"📤 来源: {source_title} ({chat_id})\n"
-                f"📝 正则: {regex_format.pattern}\n"
-                f"📝 格式: {regex_format.parse_mode}"
+                f"📋 正则格式规则（按顺序应用）\n"
+                f"📤 来源: {source_title} ({chat_id})\n" +
+                "\n".join(
+                    f"{i + 1}. 📝 正则: {rule.pattern}  格式: {rule.parse_mode}"
+                    for i, rule in enumerate(rules)
+                )
             )
         else:
             await update.message.reply_text(f"❌ 未找到 {source_title} 的则格式规则")
         
     except Exception as e:
         await update.message.reply_text(f"❌ 查询失败: {str(e)}")
-    finally:
-        session.close()
 
 async def regex_remove(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """移除指定来源的正则表达式规则"""
@@ -1177,39 +1726,45 @@ async def regex_remove(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     if not context.args:
-        await update.message.reply_text("请提供来源聊天窗口\n例如: /regex_remove https://t.me/channel_name")
+        await update.message.reply_text(
+            "请提供来源聊天窗口\n"
+            "例如: /regex_remove https://t.me/channel_name [序号]\n"
+            "不提供序号时移除全部规则"
+        )
         return
     
+    index = None
+    if len(context.args) > 1:
+        if not context.args[1].isdigit():
+            await update.message.reply_text("❌ 序号必须是数字")
+            return
+        index = int(context.args[1])
+    
     source = context.args[0]
-    session = Session()
     try:
-        # 处理链接格式
-        if 'https://t.me/' in source:
-            try:
-                chat = await client.get_entity(source)
-                chat_id = str(chat.id)
-                source_title = chat.title
-            except Exception as e:
-                await update.message.reply_text(f"❌ 获取聊天信息失败: {str(e)}")
-                return
-        else:
-            chat_id = source
-            try:
-                chat = await client.get_entity(int(chat_id))
-                source_title = chat.title
-            except:
-                source_title = chat_id
-        
-        # 删除正则格式设置
-        deleted = session.query(RegexFormat).filter(
-            RegexFormat.chat_id == chat_id
-        ).delete()
-        
-        session.commit()
+        resolved = await resolve_source(update, source)
+        if resolved is None:
+            return
+        chat_id, source_title = resolved
+        
+        async with write_session() as session:
+            # 删除正则格式设置
+            if index is None:
+                deleted = (await session.execute(
+                    delete(RegexFormat).where(RegexFormat.chat_id == chat_id)
+                )).rowcount
+            else:
+                rules = await get_regex_rules(session, chat_id)
+                deleted = 0
+                if 1 <= index <= len(rules):
+                    await session.delete(rules[index - 1])
+                    deleted = 1
+            rules = await regex_rule_list(session, chat_id)
+        routing_table.set_regex_rules(chat_id, rules)
         
         if deleted:
             await update.message.reply_text(
-                f"✅ 已移除正则格式规则\n"
+                f"✅ 已移除正则格式规则{'' if index is None else f' #{index}'}\n"
                 f"📤 来源: {source_title} ({chat_id})"
             )
         else:
@@ -1217,8 +1772,6 @@ async def regex_remove(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     except Exception as e:
         await update.message.reply_text(f"❌ 移除失败: {str(e)}")
-    finally:
-        session.close()
 
 async def preview_setting(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """置指定来源的链接预览"""
@@ -1239,44 +1792,31 @@ async def preview_setting(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ 预览设置必须是 on 或 off")
         return
     
-    session = Session()
     try:
-        # 处理链接格式
-        if 'https://t.me/' in source:
-            try:
-                chat = await client.get_entity(source)
-                chat_id = str(chat.id)
-                source_title = chat.title
-            except Exception as e:
-                await update.message.reply_text(f"❌ 获取聊天信息失败: {str(e)}")
-                return
-        else:
-            chat_id = source
-            try:
-                chat = await client.get_entity(int(chat_id))
-                source_title = chat.title
-            except:
-                source_title = chat_id
-        
-        # 更新或创建预览设置
-        preview_setting = session.query(PreviewSetting).filter(
-            PreviewSetting.chat_id == chat_id
-        ).first()
+        resolved = await resolve_source(update, source)
+        if resolved is None:
+            return
+        chat_id, source_title = resolved
         
         enable_preview = preview_mode == 'on'
         
-        if preview_setting:
-            preview_setting.enable_preview = enable_preview
-            action = "更新"
-        else:
-            preview_setting = PreviewSetting(
-                chat_id=chat_id,
-                enable_preview=enable_preview
+        async with write_session() as session:
+            # 更新或创建预览设置
+            preview_setting = await session.scalar(
+                select(PreviewSetting).where(PreviewSetting.chat_id == chat_id)
             )
-            session.add(preview_setting)
-            action = "添加"
+            
+            if preview_setting:
+                preview_setting.enable_preview = enable_preview
+                action = "更新"
+            else:
+                session.add(PreviewSetting(
+                    chat_id=chat_id,
+                    enable_preview=enable_preview
+                ))
+                action = "添加"
         
-        session.commit()
+        routing_table.set_preview(chat_id, enable_preview)
         
         await update.message.reply_text(
             f"✅ 已{action}链接预览设置\n"
@@ -1286,16 +1826,20 @@ async def preview_setting(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     except Exception as e:
         await update.message.reply_text(f"❌ 设置失败: {str(e)}")
-    finally:
-        session.close()
 
 def main():
+    # 日志在单独的线程中写出，退出前写完剩余日志
+    log_listener = setup_logging()
+    
     # 创建必要的目录
     for directory in ['sessions', 'data', 'temp']:
         os.makedirs(directory, exist_ok=True)
     
-    # Initialize database
-    init_db()
+    # 数据库在事件循环中初始化，发件箱使用独立的同步连接
+    outbox.open()
+    message_map.open()
+    entity_cache.load()
+    message_dedup.load()
     
     # Initialize bot
     global application
@@ -1309,11 +1853,14 @@ def main():
     application.add_handler(CommandHandler("remove", remove_keywords))
     application.add_handler(CommandHandler("list", list_info))
     application.add_handler(CommandHandler("export", export_keywords))
+    application.add_handler(CommandHandler("import", import_keywords))
+    application.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r'^/import'), import_keywords))
     application.add_handler(CommandHandler("switch", switch_format))
     application.add_handler(CommandHandler("regex", regex_format))
     application.add_handler(CommandHandler("regex_list", regex_list))
     application.add_handler(CommandHandler("regex_remove", regex_remove))
     application.add_handler(CommandHandler("preview", preview_setting))
+    application.add_handler(CommandHandler("status", queue_status))
     
     # 添加回调查询处理器
     application.add_handler(CallbackQueryHandler(mode_callback, pattern="^mode_"))
@@ -1323,12 +1870,12 @@ def main():
     try:
         asyncio.run(setup_and_run())
     except KeyboardInterrupt:
-        print("\n程序被用户中断")
+        logger.info("程序被用户中断")
     except Exception as e:
-        print(f"\n程序运行出错: {str(e)}")
+        logger.exception(f"程序运行出错: {str(e)}")
     finally:
-        print("\n正在关闭程序...")
+        logger.info("正在关闭程序...")
+        log_listener.stop()
 
 if __name__ == '__main__':
-    import asyncio
     main() 
@@ -0,0 +1,109 @@
+from collections import deque
+
+# 关键字较少时直接逐个查找子串更快（str 的查找在 C 中实现）
+SCAN_THRESHOLD = 16
+
+class KeywordMatcher:
+    """基于 Aho-Corasick 自动机的多关键字匹配器，一次扫描即可找出所有命中的关键字"""
+    def __init__(self, words=()):
+        self.words = set()
+        self._goto = [{}]  # 状态转移表
+        self._fail = [0]  # 失败指针
+        self._terminal = [None]  # 以该状态结尾的关键字
+        self._out = [()]  # 该状态命中的全部关键字（包含后缀）
+        self._dirty = False
+        self.update(words)
+
+    def __len__(self):
+        return len(self.words)
+
+    def __iter__(self):
+        return iter(self.words)
+
+    def __contains__(self, word):
+        return word in self.words
+
+    def update(self, words):
+        """添加关键字，只向字典树插入新节点，失败指针在下次匹配前重建"""
+        for word in words:
+            if not word or word in self.words:
+                continue
+            self.words.add(word)
+            state = 0
+            for ch in word:
+                next_state = self._goto[state].get(ch)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][ch] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._terminal.append(None)
+                    self._out.append(())
+                state = next_state
+            self._terminal[state] = word
+            self._dirty = True
+
+    def difference_update(self, words):
+        """删除关键字"""
+        for word in words:
+            if word not in self.words:
+                continue
+            self.words.discard(word)
+            state = 0
+            for ch in word:
+                state = self._goto[state][ch]
+            self._terminal[state] = None
+            self._dirty = True
+        # 删除过半时重建字典树，回收无用节点
+        if self._dirty and len(self._goto) > 2 * (sum(map(len, self.words)) + 1):
+            words = list(self.words)
+            self.clear()
+            self.update(words)
+
+    def clear(self):
+        self.words.clear()
+        self._goto = [{}]
+        self._fail = [0]
+        self._terminal = [None]
+        self._out = [()]
+        self._dirty = False
+
+    def _build(self):
+        """按广度优先顺序重建失败指针和输出表"""
+        goto, fail, terminal, out = self._goto, self._fail, self._terminal, self._out
+        queue = deque()
+        for state in goto[0].values():
+            fail[state] = 0
+            out[state] = (terminal[state],) if terminal[state] else ()
+            queue.append(state)
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in goto[state].items():
+                f = fail[state]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                f = goto[f].get(ch, 0)
+                fail[next_state] = f
+                own = (terminal[next_state],) if terminal[next_state] else ()
+                out[next_state] = own + out[f]
+                queue.append(next_state)
+        self._dirty = False
+
+    def find_all(self, text):
+        """返回文本中命中的所有关键字"""
+        if not self.words:
+            return set()
+        if len(self.words) <= SCAN_THRESHOLD:
+            return {word for word in self.words if word in text}
+        if self._dirty:
+            self._build()
+        goto, fail, out = self._goto, self._fail, self._out
+        matched = set()
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                matched.update(out[state])
+        return matched
@@ -0,0 +1,86 @@
+import asyncio
+
+# 媒体转发：分块下载到内存，所有目标共用同一份内容。
+# python-telegram-bot 上传时需要完整的文件内容，落盘并不能降低峰值内存，
+# 所以用字节预算限制同时处理中的媒体总量，峰值内存不随并发的大文件数量增长。
+
+CHUNK_SIZE = 512 * 1024  # 每次下载的块大小
+UNKNOWN_SIZE = 10 * 1024 * 1024  # 大小未知的文件按此大小占用预算
+
+class ByteBudget:
+    """限制同时处理中的媒体字节数"""
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self, size):
+        # 超过上限的按上限计算，保证单个大文件也能发送
+        size = min(size, self.limit)
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.used + size <= self.limit)
+            self.used += size
+        return size
+
+    async def release(self, size):
+        async with self._cond:
+            self.used -= size
+            self._cond.notify_all()
+
+class MediaFile:
+    """已下载的媒体文件，多个目标共用同一份内容"""
+    def __init__(self, message):
+        self.message = message
+        self.name = message.file.name if message.file else None
+        self.chunks = []
+        self._data = None
+
+    def read(self):
+        """合并下载的分块，只合并一次，所有目标共用同一个 bytes 对象"""
+        if self._data is None:
+            self._data = b''.join(self.chunks)
+            self.chunks = []
+        return self._data
+
+    def close(self):
+        self._data = None
+        self.chunks = []
+
+class MediaBatch:
+    """一条消息或一个相册的全部媒体，整体占用一次预算，避免多个相册互相等待"""
+    def __init__(self, files, budget, reserved):
+        self.files = files
+        self.budget = budget
+        self.reserved = reserved
+
+    async def close(self):
+        for media_file in self.files:
+            media_file.close()
+        await self.budget.release(self.reserved)
+        self.reserved = 0
+
+class MediaDownloader:
+    def __init__(self, memory_limit, max_size):
+        self.budget = ByteBudget(memory_limit)
+        self.max_size = max_size  # Bot API 上传大小上限
+
+    def file_size(self, message):
+        return message.file.size if message.file and message.file.size else UNKNOWN_SIZE
+
+    def too_large(self, message):
+        return self.file_size(message) > self.max_size
+
+    async def download(self, client, messages):
+        """分块下载多条消息的媒体，返回 MediaBatch，用完后需要调用 close()"""
+        reserved = await self.budget.acquire(sum(self.file_size(m) for m in messages))
+        files = [MediaFile(message) for message in messages]
+        try:
+            await asyncio.gather(*(self._fetch(client, media_file) for media_file in files))
+        except BaseException:
+            await MediaBatch(files, self.budget, reserved).close()
+            raise
+        return MediaBatch(files, self.budget, reserved)
+
+    async def _fetch(self, client, media_file):
+        async for chunk in client.iter_download(media_file.message.media, request_size=CHUNK_SIZE):
+            media_file.chunks.append(chunk)
@@ -0,0 +1,114 @@
+import asyncio
+import time
+import logging
+from sqlite_store import SQLiteStore
+
+logger = logging.getLogger(__name__)
+
+class MessageMap(SQLiteStore):
+    """来源消息 -> 转发副本的对应关系
+
+    记录每条来源消息在各目标中的副本消息ID，来源消息编辑或删除时据此更新副本。
+    保存在单独的 SQLite 文件中，表只有整数列且不带 rowid，超过 ttl 的记录定期清理。
+    写入和发件箱一样采用组提交，查询时合并尚未提交的记录。
+    """
+    def __init__(self, path, ttl=604800):
+        super().__init__(path, 'message_map')
+        self.ttl = ttl
+        self._adds = []  # (来源ID, 来源消息ID, 目标ID, 副本消息ID)
+        self._removes = []  # (来源ID, 来源消息ID)
+        self._sending = {}  # (来源ID, 来源消息ID) -> 正在发送副本的任务
+        self._purged = 0
+
+    def _setup(self):
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS copies ('
+            'source_chat_id INTEGER NOT NULL, '
+            'source_message_id INTEGER NOT NULL, '
+            'target_chat_id INTEGER NOT NULL, '
+            'message_id INTEGER NOT NULL, '
+            'created_at INTEGER NOT NULL, '
+            'PRIMARY KEY (source_chat_id, source_message_id, target_chat_id)'
+            ') WITHOUT ROWID'
+        )
+
+    def track(self, key, tasks):
+        """登记来源消息正在发送副本的任务，编辑和删除在发送完成后再查找副本"""
+        if not tasks:
+            return
+        waiter = asyncio.gather(*tasks, return_exceptions=True)
+        self._sending[key] = waiter
+        def _untrack(_):
+            if self._sending.get(key) is waiter:
+                del self._sending[key]
+        waiter.add_done_callback(_untrack)
+
+    async def settled(self, key):
+        """等待来源消息的副本发送完成"""
+        waiter = self._sending.get(key)
+        if waiter is not None:
+            await asyncio.shield(waiter)
+
+    def add(self, key, target_chat_id, message_id):
+        """记录一个副本，随下一次提交写入"""
+        self._adds.append((*key, target_chat_id, message_id))
+        self._schedule_flush()
+
+    async def lookup(self, key):
+        """返回来源消息的副本 [(目标ID, 副本消息ID)]"""
+        rows = await self._run(self._select, key)
+        copies = dict(rows)
+        # 尚未提交的记录
+        for source_chat_id, source_message_id, target_chat_id, message_id in self._adds:
+            if (source_chat_id, source_message_id) == key:
+                copies[target_chat_id] = message_id
+        return list(copies.items())
+
+    def _select(self, key):
+        return self.conn.execute(
+            'SELECT target_chat_id, message_id FROM copies '
+            'WHERE source_chat_id = ? AND source_message_id = ? AND created_at > ?',
+            (*key, int(time.time() - self.ttl))
+        ).fetchall()
+
+    async def pop(self, key):
+        """返回并删除来源消息的副本记录"""
+        copies = await self.lookup(key)
+        self._adds = [add for add in self._adds if add[:2] != key]
+        self._removes.append(key)
+        self._schedule_flush()
+        return copies
+
+    def _pending(self):
+        return self._adds or self._removes
+
+    async def _commit(self):
+        # 写入期间记录仍留在 _adds 中供查询，提交后再移除
+        adds, removes = list(self._adds), self._removes
+        self._removes = []
+        try:
+            await self._run(self._write, adds, removes)
+        except Exception as e:
+            logger.error(f"写入消息对应关系失败: {str(e)}")
+        written = set(adds)
+        self._adds = [add for add in self._adds if add not in written]
+
+    def _write(self, adds, removes):
+        now = int(time.time())
+        with self.conn:
+            if adds:
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO copies '
+                    '(source_chat_id, source_message_id, target_chat_id, message_id, created_at) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    [(*add, now) for add in adds]
+                )
+            if removes:
+                self.conn.executemany(
+                    'DELETE FROM copies WHERE source_chat_id = ? AND source_message_id = ?',
+                    removes
+                )
+            # 每小时清理一次过期记录；不为 created_at 建索引，保持表紧凑
+            if now - self._purged >= 3600:
+                self._purged = now
+                self.conn.execute('DELETE FROM copies WHERE created_at <= ?', (now - self.ttl,))
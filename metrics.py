@@ -0,0 +1,160 @@
+import asyncio
+import time
+from bisect import bisect_left
+from retry import retry_counters
+
+# 转发热路径的计数器和耗时直方图，以 Prometheus 文本格式通过本地 HTTP 端口提供。
+# 记录一次只需一次字典查找和一次二分查找，可以在生产环境中一直开启。
+
+# 耗时直方图的桶上限（秒）
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+registry = []
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter:
+    """按标签值计数，values 的键为标签值元组"""
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=(), values=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {} if values is None else values
+        registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in list(self.values.items()):
+            yield f'{self.name}{_labels(self.labels, labels)} {value}'
+
+class Gauge:
+    """抓取时调用 collect 获取当前值，collect 返回 {标签值元组: 值}"""
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), collect=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+        registry.append(self)
+
+    def samples(self):
+        for labels, value in self.collect().items():
+            yield f'{self.name}{_labels(self.labels, labels)} {value}'
+
+class Histogram:
+    """按标签值统计耗时分布，每组标签保存各个桶的计数、总和与次数"""
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}  # 标签值元组 -> [各个桶的计数（最后一个为 +Inf）, 总和]
+        registry.append(self)
+
+    def observe(self, value, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def time(self, *labels):
+        """用 with 记录代码块的耗时"""
+        return _Timer(self, labels)
+
+    def drain(self):
+        """取出并清空已记录的分布，分片工作进程随结果一起交给主进程"""
+        series, self.series = self.series, {}
+        return series
+
+    def merge(self, series):
+        """合并其他进程记录的分布"""
+        for labels, (counts, total) in series.items():
+            current = self.series.get(labels)
+            if current is None:
+                self.series[labels] = [list(counts), total]
+                continue
+            for index, count in enumerate(counts):
+                current[0][index] += count
+            current[1] += total
+
+    def samples(self):
+        for labels, (counts, total) in list(self.series.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f'{self.name}_bucket{_labels(self.labels, labels, le)} {cumulative}'
+            yield f'{self.name}_sum{_labels(self.labels, labels)} {total}'
+            yield f'{self.name}_count{_labels(self.labels, labels)} {cumulative}'
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+def render():
+    """所有指标的 Prometheus 文本格式"""
+    lines = []
+    for metric in registry:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
+
+async def _handle(reader, writer):
+    try:
+        request_line = await reader.readline()
+        # 读完请求头
+        while (await reader.readline()).strip():
+            pass
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[1] == b'/metrics':
+            status, body = '200 OK', render().encode('utf-8')
+        else:
+            status, body = '404 Not Found', b'not found\n'
+        writer.write(
+            f'HTTP/1.1 {status}\r\n'
+            'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            'Connection: close\r\n\r\n'.encode('ascii') + body
+        )
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def serve(host, port):
+    """启动指标 HTTP 服务，返回 asyncio.Server"""
+    return await asyncio.start_server(_handle, host, port)
+
+# 每个阶段的耗时：receive 事件处理到入队、queue 来源队列中等待、lookup 获取来源和绑定、
+# match 关键字匹配、regex 正则处理、download 媒体下载、send 从交给发送调度器到发送完成
+stage_seconds = Histogram('forwarder_stage_seconds', '转发各阶段耗时（秒）', ('stage', 'source', 'target'))
+events_total = Counter('forwarder_events_total', '收到的来源消息数', ('source',))
+forwarded_total = Counter('forwarder_forwarded_total', '每个目标的转发结果（sent/failed/filtered）', ('source', 'target', 'result'))
+retries_total = Counter('forwarder_retries_total', '重试次数', ('operation', 'reason'), values=retry_counters)
@@ -1,36 +1,116 @@
-from sqlalchemy import create_engine, Column, Integer, String, Boolean
+from sqlalchemy import event, Column, Integer, BigInteger, String, Boolean, MetaData, Table, Index, UniqueConstraint, inspect, select, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, StaticPool
+from telethon.utils import resolve_id
+from telethon.tl.types import PeerChat, PeerUser
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from contextlib import asynccontextmanager, nullcontext
 import os
+import asyncio
+import logging
 from dotenv import load_dotenv
 
+logger = logging.getLogger(__name__)
+
 load_dotenv()
 
+DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///data/telegram_forwarder.db')
+DB_READ_THREADS = int(os.getenv('DB_READ_THREADS', '4'))  # 并发读取的连接数，aiosqlite 每个连接一个线程
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE_MB', '256')) * 1024 * 1024
+
+# 未指定驱动时使用的异步驱动
+ASYNC_DRIVERS = {
+    'sqlite': 'aiosqlite',
+    'postgresql': 'asyncpg',
+    'mysql': 'aiomysql',
+}
+
 Base = declarative_base()
-engine = create_engine(
-    os.getenv('DATABASE_URL', 'sqlite:///data/telegram_forwarder.db'),
-    pool_size=20,  # 增加连接池大小
-    max_overflow=0,  # 禁止溢出
-    pool_timeout=30,  # 连接超时时间
-    pool_recycle=1800  # 每30分钟回收连接
-)
-Session = sessionmaker(bind=engine)
+
+def _async_url(url):
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if url.drivername == backend and backend in ASYNC_DRIVERS:
+        url = url.set(drivername=f'{backend}+{ASYNC_DRIVERS[backend]}')
+    return url
+
+def _create_engine(url):
+    url = _async_url(url)
+    if url.get_backend_name() != 'sqlite':
+        return create_async_engine(
+            url,
+            pool_size=20,  # 增加连接池大小
+            max_overflow=0,  # 禁止溢出
+            pool_timeout=30,  # 连接超时时间
+            pool_recycle=1800  # 每30分钟回收连接
+        )
+    
+    # SQLite 同一时间只能有一个写事务，连接池只需覆盖并发读和一个写连接，
+    # 复用连接避免每次操作都重新打开数据库；内存数据库只存在于单个连接中，所有操作共用一个连接
+    memory = url.database in (None, '', ':memory:')
+    sqlite_engine = create_async_engine(
+        url,
+        **({'poolclass': StaticPool} if memory else {
+            'poolclass': AsyncAdaptedQueuePool,
+            'pool_size': DB_READ_THREADS + 1,
+            'max_overflow': 0
+        })
+    )
+    
+    @event.listens_for(sqlite_engine.sync_engine, 'connect')
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if not memory:
+            # WAL 模式下读不会被写阻塞
+            cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')
+        cursor.execute('PRAGMA busy_timeout=5000')
+        cursor.close()
+    
+    return sqlite_engine
+
+engine = _create_engine(DATABASE_URL)
+# 提交后对象仍需在处理函数中读取，不在提交时过期
+Session = async_sessionmaker(engine, expire_on_commit=False)
+
+# SQLite 只允许一个写事务，写操作在进程内排队，避免并发写事务等待数据库锁
+_write_lock = asyncio.Lock() if engine.dialect.name == 'sqlite' else nullcontext()
+
+@asynccontextmanager
+async def write_session():
+    """写事务会话，正常退出时提交，出错时回滚"""
+    async with _write_lock:
+        async with Session() as session, session.begin():
+            yield session
 
 class Source(Base):
     __tablename__ = 'sources'
+    __table_args__ = (
+        UniqueConstraint('chat_id', 'target_chat_id', name='uq_sources_chat_target'),
+        Index('ix_sources_target_chat_id', 'target_chat_id'),
+    )
     
     id = Column(Integer, primary_key=True)
-    chat_id = Column(String, nullable=False)  # 来源ID
-    target_chat_id = Column(String, nullable=False)  # 目标ID
-    chat_type = Column(String, nullable=False)  # channel, group, private
+    chat_id = Column(BigInteger, nullable=False)  # 来源ID（Telethon 的真实ID）
+    target_chat_id = Column(BigInteger, nullable=False)  # 目标ID（Bot API 的ID）
+    chat_type = Column(String, nullable=False)  # channel, group（超级群组）, chat（普通群组）, private, unknown
     filter_mode = Column(String, nullable=False)  # whitelist or blacklist
     parse_mode = Column(String, default='markdown')  # markdown or html
+    last_message_id = Column(BigInteger)  # 最后处理的来源消息ID，重启后从这里补发
+    account = Column(String)  # 接收消息的账号（会话名称），为空时是主账号
 
 class Keyword(Base):
     __tablename__ = 'keywords'
+    __table_args__ = (
+        # 同时用于按目标查询关键字
+        UniqueConstraint('target_chat_id', 'word', name='uq_keywords_target_word'),
+    )
     
     id = Column(Integer, primary_key=True)
-    target_chat_id = Column(String, nullable=False)  # 关联的目标ID
+    target_chat_id = Column(BigInteger, nullable=False)  # 关联的目标ID
     word = Column(String, nullable=False)
     is_whitelist = Column(Boolean, default=True)  # True for whitelist, False for blacklist
 
@@ -38,23 +118,212 @@ class MessageFormat(Base):
     __tablename__ = 'message_formats'
     
     id = Column(Integer, primary_key=True)
-    chat_id = Column(String, nullable=False, unique=True)  # 来源聊天ID
+    chat_id = Column(BigInteger, nullable=False, unique=True)  # 来源聊天ID
     parse_mode = Column(String, nullable=False, default='markdown')  # markdown or html
 
 class RegexFormat(Base):
     __tablename__ = 'regex_formats'
+    __table_args__ = (
+        Index('ix_regex_formats_chat_position', 'chat_id', 'position'),
+    )
     
     id = Column(Integer, primary_key=True)
-    chat_id = Column(String, nullable=False, unique=True)  # 来源聊天ID,添加unique约束
+    chat_id = Column(BigInteger, nullable=False)  # 来源聊天ID，每个来源可以有多条规则
     pattern = Column(String, nullable=False)  # 正则表达式模式
     parse_mode = Column(String, nullable=False, default='markdown')  # markdown or html
+    position = Column(Integer, nullable=False, default=0)  # 规则的应用顺序
 
 class PreviewSetting(Base):
     __tablename__ = 'preview_settings'
     
     id = Column(Integer, primary_key=True)
-    chat_id = Column(String, nullable=False, unique=True)  # 来源聊天ID
+    chat_id = Column(BigInteger, nullable=False, unique=True)  # 来源聊天ID
     enable_preview = Column(Boolean, default=False)  # 是否启用预览
 
-def init_db():
-    Base.metadata.create_all(engine) 
\ No newline at end of file
+def insert_ignore(model):
+    """构建遇到唯一约束冲突时跳过的批量插入语句"""
+    if engine.dialect.name == 'postgresql':
+        return postgresql.insert(model).on_conflict_do_nothing()
+    if engine.dialect.name == 'sqlite':
+        return sqlite.insert(model).on_conflict_do_nothing()
+    return model.__table__.insert().prefix_with('IGNORE')  # MySQL
+
+class SchemaVersion(Base):
+    __tablename__ = 'schema_version'
+    
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)  # 当前数据库结构版本
+
+# 数据库结构升级，每个函数把结构升级到下一个版本。
+# 迁移中使用独立定义的表结构，不依赖模型的最新定义。
+
+def _reset_sequence(conn, name):
+    """重建表时带ID复制了旧数据，PostgreSQL 的自增序列不会跟着前进，需要设置到当前最大ID"""
+    if conn.dialect.name != 'postgresql':
+        return
+    conn.execute(text(
+        f"SELECT setval(pg_get_serial_sequence('{name}', 'id'), COALESCE(MAX(id), 0) + 1, false) FROM {name}"
+    ))
+
+def _migrate_regex_rules(conn):
+    """版本1：regex_formats 去掉 chat_id 的唯一约束，增加规则顺序"""
+    metadata = MetaData()
+    regex_formats = Table(
+        'regex_formats', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('chat_id', String, nullable=False),
+        Column('pattern', String, nullable=False),
+        Column('parse_mode', String, nullable=False, default='markdown'),
+        Column('position', Integer, nullable=False, default=0)
+    )
+    conn.execute(text('ALTER TABLE regex_formats RENAME TO regex_formats_old'))
+    regex_formats.create(conn)
+    conn.execute(text(
+        'INSERT INTO regex_formats (id, chat_id, pattern, parse_mode, position) '
+        'SELECT id, chat_id, pattern, parse_mode, 0 FROM regex_formats_old'
+    ))
+    conn.execute(text('DROP TABLE regex_formats_old'))
+    _reset_sequence(conn, 'regex_formats')
+
+def _source_id(value):
+    """旧数据中的来源ID转为 Telethon 的真实ID（去掉 -100 前缀），无法转换时返回 None"""
+    try:
+        return resolve_id(int(value))[0]
+    except (TypeError, ValueError):
+        return None
+
+def _source_kind(value):
+    """按旧数据中带前缀的来源ID判断聊天类型：普通群组和用户可以确定，频道和超级群组无法区分时返回 None"""
+    try:
+        peer_type = resolve_id(int(value))[1]
+    except (TypeError, ValueError):
+        return None
+    return {PeerChat: 'chat', PeerUser: 'private'}.get(peer_type)
+
+def _target_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def _migrate_integer_ids(conn):
+    """版本2：聊天ID改为整数，增加索引和唯一约束，去掉重复数据"""
+    metadata = MetaData()
+    tables = {
+        'sources': Table(
+            'sources', metadata,
+            Column('id', Integer, primary_key=True),
+            Column('chat_id', BigInteger, nullable=False),
+            Column('target_chat_id', BigInteger, nullable=False),
+            Column('chat_type', String, nullable=False),
+            Column('filter_mode', String, nullable=False),
+            Column('parse_mode', String, default='markdown'),
+            UniqueConstraint('chat_id', 'target_chat_id', name='uq_sources_chat_target'),
+            Index('ix_sources_target_chat_id', 'target_chat_id')
+        ),
+        'keywords': Table(
+            'keywords', metadata,
+            Column('id', Integer, primary_key=True),
+            Column('target_chat_id', BigInteger, nullable=False),
+            Column('word', String, nullable=False),
+            Column('is_whitelist', Boolean, default=True),
+            UniqueConstraint('target_chat_id', 'word', name='uq_keywords_target_word')
+        ),
+        'message_formats': Table(
+            'message_formats', metadata,
+            Column('id', Integer, primary_key=True),
+            Column('chat_id', BigInteger, nullable=False, unique=True),
+            Column('parse_mode', String, nullable=False, default='markdown')
+        ),
+        'regex_formats': Table(
+            'regex_formats', metadata,
+            Column('id', Integer, primary_key=True),
+            Column('chat_id', BigInteger, nullable=False),
+            Column('pattern', String, nullable=False),
+            Column('parse_mode', String, nullable=False, default='markdown'),
+            Column('position', Integer, nullable=False, default=0),
+            Index('ix_regex_formats_chat_position', 'chat_id', 'position')
+        ),
+        'preview_settings': Table(
+            'preview_settings', metadata,
+            Column('id', Integer, primary_key=True),
+            Column('chat_id', BigInteger, nullable=False, unique=True),
+            Column('enable_preview', Boolean, default=False)
+        ),
+    }
+    # 每张表中需要转换的列，以及决定唯一性的列
+    conversions = {
+        'sources': ({'chat_id': _source_id, 'target_chat_id': _target_id}, ('chat_id', 'target_chat_id')),
+        'keywords': ({'target_chat_id': _target_id}, ('target_chat_id', 'word')),
+        'message_formats': ({'chat_id': _source_id}, ('chat_id',)),
+        'regex_formats': ({'chat_id': _source_id}, None),
+        'preview_settings': ({'chat_id': _source_id}, ('chat_id',)),
+    }
+    
+    for name, table in tables.items():
+        converters, unique_columns = conversions[name]
+        old_name = f'{name}_old'
+        conn.execute(text(f'ALTER TABLE {name} RENAME TO {old_name}'))
+        rows = conn.execute(text(f'SELECT * FROM {old_name} ORDER BY id')).mappings().all()
+        
+        new_rows = []
+        seen = set()
+        for row in rows:
+            row = dict(row)
+            # 旧版本无法识别普通群组和用户，类型记为 unknown，趁ID还带前缀时补上
+            if name == 'sources' and row['chat_type'] == 'unknown':
+                row['chat_type'] = _source_kind(row['chat_id']) or 'unknown'
+            for column, convert in converters.items():
+                row[column] = convert(row[column])
+            if any(row[column] is None for column in converters):
+                logger.warning(f"跳过无法转换的数据 {name}: {dict(row)}")
+                continue
+            # 保留最早的一条重复数据
+            if unique_columns:
+                key = tuple(row[column] for column in unique_columns)
+                if key in seen:
+                    continue
+                seen.add(key)
+            new_rows.append(row)
+        
+        conn.execute(text(f'DROP TABLE {old_name}'))
+        table.create(conn)
+        if new_rows:
+            conn.execute(table.insert(), new_rows)
+        _reset_sequence(conn, name)
+
+def _migrate_last_message_id(conn):
+    """版本3：sources 增加最后处理的消息ID"""
+    conn.execute(text('ALTER TABLE sources ADD COLUMN last_message_id BIGINT'))
+
+def _migrate_account(conn):
+    """版本4：sources 增加接收消息的账号"""
+    conn.execute(text('ALTER TABLE sources ADD COLUMN account VARCHAR'))
+
+MIGRATIONS = [
+    _migrate_regex_rules,
+    _migrate_integer_ids,
+    _migrate_last_message_id,
+    _migrate_account,
+]
+
+def _init_db(conn):
+    # 没有 sources 表说明是新数据库，直接按最新结构创建
+    fresh = not inspect(conn).has_table('sources')
+    Base.metadata.create_all(conn)
+    
+    version = conn.execute(select(SchemaVersion.version)).scalar()
+    if version is None:
+        version = len(MIGRATIONS) if fresh else 0
+        conn.execute(SchemaVersion.__table__.insert().values(id=1, version=version))
+    
+    for migration in MIGRATIONS[version:]:
+        version += 1
+        logger.info(f"升级数据库结构到版本 {version}")
+        migration(conn)
+        conn.execute(SchemaVersion.__table__.update().values(version=version))
+
+async def init_db():
+    # 迁移代码使用同步接口，通过 run_sync 在异步连接上执行
+    async with engine.begin() as conn:
+        await conn.run_sync(_init_db)
@@ -0,0 +1,118 @@
+import asyncio
+import json
+import time
+import logging
+from sqlite_store import SQLiteStore
+
+logger = logging.getLogger(__name__)
+
+class Outbox(SQLiteStore):
+    """持久化发件箱
+
+    转发任务在发送前写入 SQLite，发送完成后删除，进程崩溃或重启后可以重放未完成的任务。
+    队列溢出时也可以只写入不发送（spill），之后由 claim 分批取出发送。
+    写入采用组提交：同一时间只有一个事务在写，期间到达的任务合并到下一个事务中一起提交，
+    空闲时不增加额外延迟，高负载时一次提交可以覆盖大量任务。
+    """
+    def __init__(self, path):
+        super().__init__(path, 'outbox')
+        self.next_id = 1
+        self._adds = []  # (job_id, chat_id, payload, future)
+        self._dones = []  # job_id
+        self.inflight = set()  # 已交给发送流程、尚未完成的任务
+
+    def _setup(self):
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'id INTEGER PRIMARY KEY, '
+            'chat_id INTEGER NOT NULL, '
+            'payload TEXT NOT NULL, '
+            'created_at REAL NOT NULL)'
+        )
+        row = self.conn.execute('SELECT MAX(id) FROM jobs').fetchone()
+        self.next_id = (row[0] or 0) + 1
+
+    async def backlog(self):
+        """未交给发送流程的任务数（包括上次运行遗留的和溢出写入的）"""
+        total = await self._run(self._count)
+        return total - len(self.inflight)
+
+    def _count(self):
+        return self.conn.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+
+    async def claim(self, limit):
+        """取出最多 limit 个未交给发送流程的任务 [(job_id, chat_id, kwargs)]"""
+        rows = await self._run(self._select, limit + len(self.inflight))
+        jobs = []
+        for job_id, chat_id, payload in rows:
+            if job_id in self.inflight:
+                continue
+            self.inflight.add(job_id)
+            jobs.append((job_id, int(chat_id), json.loads(payload)))
+            if len(jobs) >= limit:
+                break
+        return jobs
+
+    def _select(self, limit):
+        return self.conn.execute('SELECT id, chat_id, payload FROM jobs ORDER BY id LIMIT ?', (limit,)).fetchall()
+
+    async def add(self, chat_id, kwargs):
+        """写入任务并交给发送流程，提交到磁盘后返回任务ID"""
+        return await self._append(chat_id, kwargs, inflight=True)
+
+    async def spill(self, chat_id, kwargs):
+        """只写入任务，稍后由 claim 取出发送"""
+        return await self._append(chat_id, kwargs, inflight=False)
+
+    async def _append(self, chat_id, kwargs, inflight):
+        job_id = self.next_id
+        self.next_id += 1
+        if inflight:
+            # 提交前就标记，避免 claim 重复取出
+            self.inflight.add(job_id)
+        future = asyncio.get_running_loop().create_future()
+        self._adds.append((job_id, chat_id, json.dumps(kwargs, ensure_ascii=False), future))
+        self._schedule_flush()
+        await future
+        return job_id
+
+    def done(self, job_id):
+        """标记任务完成，随下一次提交一起删除"""
+        # 删除提交前仍保留在 inflight 中，避免 claim 再次取出
+        self._dones.append(job_id)
+        self._schedule_flush()
+
+    def _pending(self):
+        return self._adds or self._dones
+
+    async def _commit(self):
+        adds, self._adds = self._adds, []
+        dones, self._dones = self._dones, []
+        try:
+            await self._run(self._write, adds, dones)
+        except Exception as e:
+            logger.error(f"写入发件箱失败: {str(e)}")
+            for job_id, *_, future in adds:
+                self.inflight.discard(job_id)
+                if not future.done():
+                    future.set_exception(e)
+            # 已完成的任务放回，下次提交时再删除，稍等后重试，避免磁盘故障时空转
+            self._dones[:0] = dones
+            if dones:
+                await asyncio.sleep(1)
+            return
+        self.inflight.difference_update(dones)
+        for *_, future in adds:
+            if not future.done():
+                future.set_result(None)
+
+    def _write(self, adds, dones):
+        now = time.time()
+        with self.conn:
+            if adds:
+                self.conn.executemany(
+                    'INSERT INTO jobs (id, chat_id, payload, created_at) VALUES (?, ?, ?, ?)',
+                    [(job_id, chat_id, payload, now) for job_id, chat_id, payload, _ in adds]
+                )
+            if dones:
+                self.conn.executemany('DELETE FROM jobs WHERE id = ?', [(job_id,) for job_id in dones])
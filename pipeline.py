@@ -0,0 +1,96 @@
+import asyncio
+import time
+import logging
+from collections import deque
+from metrics import stage_seconds
+from logs import fields
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_MODES = ('block', 'drop_oldest', 'spill')
+
+class SourceQueues:
+    """按来源划分的有界队列
+
+    事件处理函数只负责入队，由固定数量的工作协程完成过滤、格式化和转发。
+    同一来源同时只有一个工作协程在处理，保证来源内的顺序；
+    多个来源按轮询顺序处理，一个慢来源不会阻塞其他来源。
+
+    队列满时的处理方式：
+    - block: 入队等待，直到有空位
+    - drop_oldest: 丢弃最早的一条
+    - spill: 交给 spill 函数直接写入发件箱，spill 返回 False 时退回到 block
+    """
+    def __init__(self, handler, workers=8, maxsize=100, overflow='block', spill=None):
+        if overflow not in OVERFLOW_MODES:
+            raise ValueError(f"未知的队列溢出处理方式: {overflow}")
+        self.handler = handler
+        self.workers = workers
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.spill = spill
+        self.queues = {}  # 来源ID -> deque[(入队时间, 事件)]
+        self.ready = deque()  # 等待处理的来源ID
+        self.busy = set()  # 已在 ready 中或正在处理的来源
+        self.dropped = 0
+        self.spilled = 0
+        # 在构造时创建，start() 之前入队也不会出错，工作协程启动后处理
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Condition()
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def depths(self):
+        """每个来源排队中的事件数"""
+        return {chat_id: len(queue) for chat_id, queue in self.queues.items() if queue}
+
+    async def put(self, chat_id, item, block=False):
+        """队列已满时按溢出策略处理；block 为 True 时总是等待空位，补发的消息不能丢弃或乱序"""
+        queue = self.queues.setdefault(chat_id, deque())
+        if len(queue) >= self.maxsize:
+            if not block and self.overflow == 'drop_oldest':
+                queue.popleft()
+                self.dropped += 1
+                logger.warning("来源队列已满，丢弃最早的消息", extra=fields(source=chat_id))
+            elif not block and self.overflow == 'spill' and self.spill and await self.spill(item):
+                self.spilled += 1
+                return
+            else:
+                async with self._space:
+                    await self._space.wait_for(lambda: len(queue) < self.maxsize)
+        queue.append((time.perf_counter(), item))
+        if chat_id not in self.busy:
+            self.busy.add(chat_id)
+            self.ready.append(chat_id)
+            self._wakeup.set()
+
+    async def _worker(self):
+        while True:
+            if not self.ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            chat_id = self.ready.popleft()
+            queue = self.queues[chat_id]
+            enqueued, item = queue.popleft()
+            stage_seconds.observe(time.perf_counter() - enqueued, 'queue', chat_id, '')
+            async with self._space:
+                self._space.notify_all()
+            try:
+                await self.handler(item)
+            except Exception as e:
+                logger.exception(f"处理消息时出错: {str(e)}", extra=fields(source=chat_id))
+            # 处理完一条后排到轮询末尾
+            if queue:
+                self.ready.append(chat_id)
+                self._wakeup.set()
+            else:
+                self.busy.discard(chat_id)
@@ -0,0 +1,83 @@
+import asyncio
+import functools
+import random
+import time
+import logging
+from collections import Counter
+from telethon.errors import FloodWaitError, ServerError
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+
+logger = logging.getLogger(__name__)
+
+# 重试次数统计：(操作名称, 原因) -> 次数，用于 /status 和监控
+retry_counters = Counter()
+
+def retry_after_seconds(error):
+    """兼容 RetryAfter.retry_after 为秒数或 timedelta 的情况"""
+    retry_after = error.retry_after
+    if hasattr(retry_after, 'total_seconds'):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+class RetryPolicy:
+    """指数退避重试策略，带随机抖动和单次调用的总时限"""
+    def __init__(self, max_retries=3, base_delay=1, max_delay=30, deadline=60):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline  # 包括所有重试在内的总时长上限（秒）
+
+    def backoff(self, attempt):
+        """第 attempt 次重试前的等待时间，在 [delay/2, delay] 之间随机，避免多个调用同时重试"""
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return delay * random.uniform(0.5, 1)
+
+def retry_reason(error):
+    """可以重试的错误返回 (原因, 服务端要求的等待秒数)，否则返回 None"""
+    if isinstance(error, FloodWaitError):
+        return 'flood_wait', error.seconds
+    if isinstance(error, RetryAfter):
+        return 'retry_after', retry_after_seconds(error)
+    if isinstance(error, ServerError):
+        return 'server_error', None
+    # BadRequest 是 NetworkError 的子类，重试没有意义；
+    # 发送超时时消息可能已经送达，重试会重复发送，只重试连接错误
+    if isinstance(error, NetworkError) and not isinstance(error, (BadRequest, TimedOut)):
+        return 'network_error', None
+    return None
+
+async def retry_call(func, *args, policy=None, name=None, **kwargs):
+    """调用 func，遇到可重试的错误时按策略等待后重试，不阻塞事件循环"""
+    policy = policy or DEFAULT_POLICY
+    name = name or func.__name__
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        try:
+            return await func(*args, **kwargs)
+        except Exception as e:
+            reason = retry_reason(e)
+            if reason is None or attempt >= policy.max_retries:
+                raise
+            reason, wait = reason
+            if wait is None:
+                wait = policy.backoff(attempt)
+            # 等待后会超过总时限时不再重试
+            if time.monotonic() - started + wait > policy.deadline:
+                raise
+            attempt += 1
+            retry_counters[name, reason] += 1
+            logger.warning(f"{name} 出错 ({reason})，{wait:.1f}秒后重试 ({attempt}/{policy.max_retries})")
+            await asyncio.sleep(wait)
+
+def retry_on_server_error(max_retries=3, delay=1, max_delay=30, deadline=60):
+    """异步函数的重试装饰器"""
+    policy = RetryPolicy(max_retries, delay, max_delay, deadline)
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await retry_call(func, *args, policy=policy, name=func.__name__, **kwargs)
+        return wrapper
+    return decorator
+
+DEFAULT_POLICY = RetryPolicy()
@@ -0,0 +1,199 @@
+import re
+import logging
+from collections import defaultdict
+from sqlalchemy import select
+from telethon.utils import resolve_id
+from matcher import KeywordMatcher
+from models import Session, Source, Keyword, MessageFormat, RegexFormat, PreviewSetting
+from logs import fields
+
+logger = logging.getLogger(__name__)
+
+# 内存路由表：启动时从数据库加载，命令修改数据库时同步更新，
+# 转发热路径只读这里，不再访问数据库
+
+def peer_id(chat_id):
+    """将来源ID转换为 Telethon 的真实ID（去掉 -100 等前缀）"""
+    try:
+        return resolve_id(int(chat_id))[0]
+    except (TypeError, ValueError):
+        return None
+
+class RegexPipeline:
+    """来源的正则规则，编译一次后按顺序依次应用"""
+    def __init__(self, rules=()):
+        # 先全部编译，任何一条失败都不替换已有规则
+        self.rules = [(re.compile(pattern), parse_mode) for pattern, parse_mode in rules]
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    @property
+    def parse_mode(self):
+        # 以最后一条规则的格式为准
+        return self.rules[-1][1]
+
+    def apply(self, text):
+        for pattern, _ in self.rules:
+            text = pattern.sub('', text)
+        return text
+
+class SourceFormat:
+    """来源的格式设置（解析格式、正则规则、链接预览）"""
+    def __init__(self):
+        self.default_parse_mode = 'markdown'  # MessageFormat 设置
+        self.regex = RegexPipeline()
+        self.disable_preview = True  # 默认关闭预览
+
+    @property
+    def parse_mode(self):
+        # 有正则规则时使用正则规则的格式
+        if self.regex:
+            return self.regex.parse_mode
+        return self.default_parse_mode
+
+class Binding:
+    """一条来源 -> 目标的绑定"""
+    def __init__(self, chat_id, target_chat_id, filter_mode, keywords, format):
+        self.chat_id = chat_id
+        self.target_chat_id = target_chat_id
+        self.filter_mode = filter_mode
+        self.keywords = keywords  # 与同一目标的其他绑定共享
+        self.format = format  # 与同一来源的其他绑定共享
+
+class RoutingTable:
+    def __init__(self):
+        self.bindings = {}  # 来源ID -> {目标ID: Binding}
+        self.keywords = {}  # 目标ID -> KeywordMatcher
+        self.formats = {}  # 来源ID -> SourceFormat
+        self.source_ids = set()  # 已绑定来源的真实ID，用于事件预过滤
+        self.listeners = []  # 路由配置变化时调用，如通知分片工作进程重新加载
+
+    async def load(self, owns=None):
+        """从数据库加载路由信息，owns(来源ID) 为 False 的来源及只属于这些来源的设置不加载"""
+        async with Session() as session:
+            keywords = (await session.execute(select(Keyword.target_chat_id, Keyword.word))).all()
+            formats = (await session.scalars(select(MessageFormat))).all()
+            previews = (await session.scalars(select(PreviewSetting))).all()
+            regex_rules = (await session.scalars(
+                select(RegexFormat).order_by(RegexFormat.position, RegexFormat.id)
+            )).all()
+            sources = (await session.scalars(select(Source))).all()
+        
+        if owns is not None:
+            sources = [source for source in sources if owns(source.chat_id)]
+            source_ids = {source.chat_id for source in sources}
+            target_ids = {source.target_chat_id for source in sources}
+            keywords = [row for row in keywords if row[0] in target_ids]
+            formats = [setting for setting in formats if setting.chat_id in source_ids]
+            previews = [setting for setting in previews if setting.chat_id in source_ids]
+            regex_rules = [rule for rule in regex_rules if rule.chat_id in source_ids]
+        
+        self.bindings.clear()
+        self.source_ids.clear()
+        self.keywords.clear()
+        self.formats.clear()
+        
+        words = defaultdict(list)
+        for target_chat_id, word in keywords:
+            words[target_chat_id].append(word)
+        for target_chat_id, target_words in words.items():
+            self._keywords(target_chat_id).update(target_words)
+        
+        for setting in formats:
+            self._format(setting.chat_id).default_parse_mode = setting.parse_mode
+        
+        for setting in previews:
+            self._format(setting.chat_id).disable_preview = not setting.enable_preview
+        
+        rules = defaultdict(list)
+        for rule in regex_rules:
+            rules[rule.chat_id].append((rule.pattern, rule.parse_mode))
+        for chat_id, source_rules in rules.items():
+            try:
+                self._format(chat_id).regex = RegexPipeline(source_rules)
+            except re.error as e:
+                logger.error(f"正则表达式错误: {str(e)}", extra=fields(source=chat_id))
+        
+        for source in sources:
+            self._add_binding(source.chat_id, source.target_chat_id, source.filter_mode)
+
+    def _changed(self):
+        """命令修改路由配置后通知监听者，load 不通知"""
+        for listener in self.listeners:
+            listener()
+
+    def _keywords(self, target_chat_id):
+        matcher = self.keywords.get(target_chat_id)
+        if matcher is None:
+            matcher = self.keywords[target_chat_id] = KeywordMatcher()
+        return matcher
+
+    def _format(self, chat_id):
+        return self.formats.setdefault(chat_id, SourceFormat())
+
+    def has_source(self, chat_id):
+        """判断事件的 chat_id 是否属于已绑定的来源"""
+        return peer_id(chat_id) in self.source_ids
+
+    def get(self, chat_id):
+        """获取来源的所有绑定"""
+        targets = self.bindings.get(chat_id)
+        return list(targets.values()) if targets else []
+
+    def add_binding(self, chat_id, target_chat_id, filter_mode):
+        self._add_binding(chat_id, target_chat_id, filter_mode)
+        self._changed()
+
+    def _add_binding(self, chat_id, target_chat_id, filter_mode):
+        self.bindings.setdefault(chat_id, {})[target_chat_id] = Binding(
+            chat_id,
+            target_chat_id,
+            filter_mode,
+            self._keywords(target_chat_id),
+            self._format(chat_id)
+        )
+        self.source_ids.add(peer_id(chat_id))
+
+    def set_filter_mode(self, chat_id, target_chat_id, filter_mode):
+        binding = self.bindings.get(chat_id, {}).get(target_chat_id)
+        if binding:
+            binding.filter_mode = filter_mode
+        self._changed()
+
+    def remove_chat(self, chat_id):
+        """移除某窗口作为来源或目标的所有绑定及其关键字，chat_id 为 Bot API 的ID"""
+        self.bindings.pop(peer_id(chat_id), None)
+        for source_id in list(self.bindings):
+            targets = self.bindings[source_id]
+            targets.pop(chat_id, None)
+            if not targets:
+                del self.bindings[source_id]
+        self.source_ids = {peer_id(source_id) for source_id in self.bindings}
+        # 原地清空，已有的绑定仍引用同一个匹配器
+        self._keywords(chat_id).clear()
+        self._changed()
+
+    def add_keywords(self, target_chat_id, words):
+        self._keywords(target_chat_id).update(words)
+        self._changed()
+
+    def remove_keywords(self, target_chat_id, words):
+        self._keywords(target_chat_id).difference_update(words)
+        self._changed()
+
+    def set_parse_mode(self, chat_id, parse_mode):
+        self._format(chat_id).default_parse_mode = parse_mode
+        self._changed()
+
+    def set_regex_rules(self, chat_id, rules):
+        """替换来源的正则规则 [(pattern, parse_mode)]，规则变化时重新编译"""
+        self._format(chat_id).regex = RegexPipeline(rules)
+        self._changed()
+
+    def set_preview(self, chat_id, enable_preview):
+        self._format(chat_id).disable_preview = not enable_preview
+        self._changed()
+
+# 全局路由表实例
+routing_table = RoutingTable()
@@ -0,0 +1,195 @@
+import asyncio
+import time
+import logging
+from collections import deque
+from telegram.error import RetryAfter
+from retry import RetryPolicy, retry_after_seconds, retry_counters, retry_reason
+from logs import fields
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    """令牌桶限速器"""
+    def __init__(self, rate, capacity):
+        self.rate = rate  # 每秒补充的令牌数
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """返回距离下一个令牌可用还需等待的秒数"""
+        now = time.monotonic()
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self._refill(time.monotonic())
+        self.tokens -= 1
+
+class SendJob:
+    def __init__(self, method, kwargs, future):
+        self.method = method  # Bot 的发送方法名
+        self.kwargs = kwargs
+        self.future = future
+        self.attempts = 0  # 已重试次数
+        self.started = None  # 第一次发送的时间
+
+class SendScheduler:
+    """出站消息调度器
+
+    每个目标一个队列，多个发送协程按轮询顺序公平地取队列，
+    同时受全局令牌桶和每个目标的令牌桶限速。
+    遇到 RetryAfter 时暂停该目标并在等待后重发，不会丢弃消息；
+    连接错误按重试策略退避后重发，超过次数或时限后才返回错误。
+    同一目标同时只有一条消息在发送，保证目标内的顺序。
+    """
+    def __init__(self, workers=10, global_rate=30, chat_rate=1, group_rate=20, retry_policy=None):
+        self.workers = workers
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate  # 私聊每秒条数
+        self.group_rate = group_rate  # 群组/频道每分钟条数
+        self.buckets = {}  # 目标ID -> TokenBucket
+        self.queues = {}  # 目标ID -> deque[SendJob]
+        self.ready = deque()  # 可以发送的目标ID，轮询顺序
+        self.busy = set()  # 已在 ready 中、等待中或正在发送的目标
+        self.bot = None
+        # 在构造时创建，start() 之前提交的发送请求等工作协程启动后处理
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+
+    def _bucket(self, chat_id):
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            # 负数ID为群组或频道
+            if int(chat_id) < 0:
+                bucket = TokenBucket(self.group_rate / 60, self.group_rate)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_rate)
+            self.buckets[chat_id] = bucket
+        return bucket
+
+    def start(self, bot):
+        self.bot = bot
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def pending(self):
+        """每个目标排队中的消息数"""
+        return {chat_id: len(queue) for chat_id, queue in self.queues.items()}
+
+    async def send(self, method, chat_id, **kwargs):
+        """将发送请求加入目标队列，发送完成后返回 Bot 方法的结果"""
+        future = asyncio.get_running_loop().create_future()
+        job = SendJob(method, dict(chat_id=chat_id, **kwargs), future)
+        self.queues.setdefault(chat_id, deque()).append(job)
+        if chat_id not in self.busy:
+            self._make_ready(chat_id)
+        return await future
+
+    async def send_message(self, chat_id, **kwargs):
+        return await self.send('send_message', chat_id, **kwargs)
+
+    async def send_media_group(self, chat_id, **kwargs):
+        return await self.send('send_media_group', chat_id, **kwargs)
+
+    def _make_ready(self, chat_id):
+        self.busy.add(chat_id)
+        self.ready.append(chat_id)
+        self._wakeup.set()
+
+    def _release(self, chat_id):
+        """目标处理完一条后，如果还有消息则排到轮询末尾"""
+        if self.queues.get(chat_id):
+            self.ready.append(chat_id)
+            self._wakeup.set()
+        else:
+            self.queues.pop(chat_id, None)
+            self.busy.discard(chat_id)
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            chat_id = self.ready.popleft()
+
+            # 目标限速未到时不占用发送协程，稍后再放回队列
+            wait = self._bucket(chat_id).delay()
+            if wait > 0:
+                loop.call_later(wait, self._requeue, chat_id)
+                continue
+
+            wait = self.global_bucket.delay()
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = self.global_bucket.delay()
+            self.global_bucket.consume()
+            self._bucket(chat_id).consume()
+
+            queue = self.queues[chat_id]
+            job = queue.popleft()
+            if job.future.cancelled():
+                self._release(chat_id)
+                continue
+            if job.started is None:
+                job.started = time.monotonic()
+            try:
+                result = await getattr(self.bot, job.method)(**job.kwargs)
+            except RetryAfter as e:
+                # 触发限流，放回队首，等待后重发
+                seconds = retry_after_seconds(e)
+                logger.warning(f"触发限流，{seconds}秒后重发", extra=fields(target=chat_id))
+                retry_counters['send', 'retry_after'] += 1
+                queue.appendleft(job)
+                loop.call_later(seconds, self._requeue, chat_id)
+                continue
+            except Exception as e:
+                wait = self._retry_delay(job, e)
+                if wait is not None:
+                    # 放回队首，等待期间不占用发送协程
+                    logger.warning(
+                        f"发送失败: {str(e)}，{wait:.1f}秒后重发 ({job.attempts}/{self.retry_policy.max_retries})",
+                        extra=fields(target=chat_id)
+                    )
+                    queue.appendleft(job)
+                    loop.call_later(wait, self._requeue, chat_id)
+                    continue
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                if not job.future.done():
+                    job.future.set_result(result)
+            self._release(chat_id)
+
+    def _retry_delay(self, job, error):
+        """可以重发时返回等待秒数，否则返回 None"""
+        reason = retry_reason(error)
+        policy = self.retry_policy
+        if reason is None or job.attempts >= policy.max_retries:
+            return None
+        reason, wait = reason
+        if wait is None:
+            wait = policy.backoff(job.attempts)
+        if time.monotonic() - job.started + wait > policy.deadline:
+            return None
+        job.attempts += 1
+        retry_counters['send', reason] += 1
+        return wait
+
+    def _requeue(self, chat_id):
+        self.ready.append(chat_id)
+        self._wakeup.set()
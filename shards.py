@@ -0,0 +1,247 @@
+import asyncio
+import itertools
+import logging
+import os
+import pickle
+import signal
+import socket
+import struct
+import sys
+from multiprocessing.connection import Connection
+from metrics import stage_seconds
+from logs import fields
+
+logger = logging.getLogger(__name__)
+
+# 分片模式：Telegram 客户端和 Bot 只在主进程中运行，负责接收事件、下载媒体和发送；
+# 关键字匹配和正则处理按来源ID分片交给多个工作进程，每个工作进程只加载自己负责的来源。
+# 主进程和工作进程之间通过 socketpair 传递请求和结果，消息格式与 multiprocessing 的 Connection 相同：
+# 工作进程直接使用 Connection；主进程在事件循环中用 asyncio 流读写，不经过线程，发送不阻塞事件循环。
+# 工作进程中记录的匹配和正则耗时随结果一起返回，合并到主进程的指标中导出。
+
+WORKER_SCRIPT = os.path.abspath(__file__)
+RESTART_DELAY = 1  # 工作进程退出后等待多久重启
+
+def shard_of(chat_id, shards):
+    """来源真实ID所属的分片"""
+    return chat_id % shards
+
+def _frame(obj):
+    """按 Connection 的格式打包：4 字节大端长度 + pickle，超过 2GB 时长度为 -1 后接 8 字节长度"""
+    data = pickle.dumps(obj)
+    if len(data) > 0x7fffffff:
+        return struct.pack('!iQ', -1, len(data)) + data
+    return struct.pack('!i', len(data)) + data
+
+async def _receive(reader):
+    """读取一条 Connection 格式的消息"""
+    size, = struct.unpack('!i', await reader.readexactly(4))
+    if size == -1:
+        size, = struct.unpack('!Q', await reader.readexactly(8))
+    return pickle.loads(await reader.readexactly(size))
+
+class ShardPool:
+    """分片工作进程的监督者
+
+    启动 shards 个工作进程，工作进程意外退出后自动重启。
+    请求按来源ID分配给对应的工作进程，每个工作进程一个读取协程接收结果。
+    工作进程不可用时 format 返回 None，由调用方在主进程中处理。
+    """
+    def __init__(self, shards):
+        self.shards = shards
+        self.writers = [None] * shards
+        self.pending = {}  # 请求ID -> (分片, future)
+        self.restarts = 0
+        self._ids = itertools.count(1)
+        self._loop = None
+        self._processes = [None] * shards
+        self._readers = [None] * shards
+        self._tasks = []
+        # 每个工作进程需要完成的加载次数（启动和每次通知重新加载）与已完成的次数
+        self._loads = [0] * shards
+        self._loaded = [0] * shards
+        self._ready = asyncio.Condition()
+        self._reload_scheduled = False
+        self._closing = False
+
+    async def start(self):
+        """启动工作进程，等待全部加载完路由配置后返回"""
+        self._loop = asyncio.get_running_loop()
+        for index in range(self.shards):
+            await self._launch(index)
+        self._tasks = [asyncio.create_task(self._supervise(index)) for index in range(self.shards)]
+        await self.wait_ready()
+
+    async def _launch(self, index):
+        parent, child = socket.socketpair()
+        try:
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, WORKER_SCRIPT, str(index), str(self.shards), str(child.fileno()),
+                pass_fds=(child.fileno(),)
+            )
+        except Exception:
+            parent.close()
+            raise
+        finally:
+            child.close()
+        reader, writer = await asyncio.open_unix_connection(sock=parent)
+        self._processes[index] = process
+        self.writers[index] = writer
+        # 工作进程启动后先加载一次路由配置
+        self._loads[index] = 1
+        self._loaded[index] = 0
+        self._readers[index] = asyncio.create_task(self._read(index, reader))
+
+    async def _read(self, index, reader):
+        """读取协程：接收工作进程返回的结果和加载完成的通知"""
+        while True:
+            try:
+                response = await _receive(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return
+            if response[0] == 'loaded':
+                self._loaded[index] += 1
+                async with self._ready:
+                    self._ready.notify_all()
+            else:
+                self._resolve(response)
+
+    async def wait_ready(self):
+        """等待运行中的工作进程完成所有已通知的加载"""
+        async with self._ready:
+            await self._ready.wait_for(lambda: all(
+                self._loaded[index] >= self._loads[index]
+                for index in range(self.shards) if self.writers[index] is not None
+            ))
+
+    def _resolve(self, response):
+        _, request_id, targets, filtered, timings = response
+        stage_seconds.merge(timings)
+        entry = self.pending.pop(request_id, None)
+        if entry is not None and not entry[1].done():
+            entry[1].set_result((targets, filtered))
+
+    async def _supervise(self, index):
+        while True:
+            returncode = await self._processes[index].wait()
+            writer, self.writers[index] = self.writers[index], None
+            # 先读完工作进程退出前已返回的结果，再关闭连接
+            await self._readers[index]
+            writer.close()
+            async with self._ready:
+                self._ready.notify_all()
+            # 未返回的请求交回主进程处理
+            for request_id, (shard, future) in list(self.pending.items()):
+                if shard == index:
+                    del self.pending[request_id]
+                    if not future.done():
+                        future.set_result(None)
+            if self._closing:
+                return
+            logger.error(f"分片工作进程退出 (code {returncode})，{RESTART_DELAY}秒后重启", extra=fields(shard=index))
+            self.restarts += 1
+            await asyncio.sleep(RESTART_DELAY)
+            try:
+                await self._launch(index)
+            except Exception as e:
+                logger.error(f"启动分片工作进程失败: {str(e)}", extra=fields(shard=index))
+                return
+
+    async def format(self, chat_id, message_text, media=False):
+        """交给来源所属的工作进程过滤和格式化，返回 ([(目标ID, 内容)], [被过滤的目标ID])"""
+        index = shard_of(chat_id, self.shards)
+        writer = self.writers[index]
+        if writer is None or writer.is_closing():
+            return None
+        request_id = next(self._ids)
+        future = self._loop.create_future()
+        self.pending[request_id] = (index, future)
+        # 写入发送缓冲区后立即返回，不等待工作进程读取；
+        # 每个请求都等待结果，缓冲区大小受同时处理的来源数限制
+        writer.write(_frame(('format', request_id, chat_id, message_text, media)))
+        return await future
+
+    def reload(self):
+        """路由配置变化后通知所有工作进程从数据库重新加载，同一轮事件循环中的多次变化只通知一次"""
+        if self._loop is None or self._reload_scheduled:
+            return
+        self._reload_scheduled = True
+        # 通知前就计入，调用方随后 wait_ready 会等待这次加载
+        for index, writer in enumerate(self.writers):
+            if writer is not None:
+                self._loads[index] += 1
+        self._loop.call_soon(self._broadcast_reload)
+
+    def _broadcast_reload(self):
+        self._reload_scheduled = False
+        # 已退出的工作进程重启后会重新加载
+        self._broadcast(('reload',))
+
+    def _broadcast(self, request):
+        for writer in self.writers:
+            if writer is not None and not writer.is_closing():
+                writer.write(_frame(request))
+
+    def alive(self):
+        """正在运行的工作进程数"""
+        return sum(writer is not None for writer in self.writers)
+
+    async def stop(self, timeout=5):
+        self._closing = True
+        self._broadcast(('stop',))
+        processes = [process for process in self._processes if process is not None]
+        try:
+            await asyncio.wait_for(asyncio.gather(*(process.wait() for process in processes)), timeout)
+        except asyncio.TimeoutError:
+            for process in processes:
+                if process.returncode is None:
+                    process.kill()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+def run_worker(index, shards, fd):
+    """工作进程：加载负责的来源，依次处理主进程发来的请求"""
+    from logs import setup_logging
+    from models import engine
+    from routing import RoutingTable
+    from filtering import format_bindings
+
+    # Ctrl+C 会发给整个进程组，由主进程通知退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    log_listener = setup_logging()
+    conn = Connection(fd)
+    table = RoutingTable()
+    owns = lambda chat_id: shard_of(chat_id, shards) == index
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(table.load(owns))
+        conn.send(('loaded',))
+        logger.info(f"分片工作进程已启动，负责 {len(table.bindings)} 个来源", extra=fields(shard=index))
+        while True:
+            try:
+                request = conn.recv()
+            except EOFError:
+                break
+            kind = request[0]
+            if kind == 'format':
+                _, request_id, chat_id, message_text, media = request
+                targets, filtered = format_bindings(table.get(chat_id), message_text, media)
+                conn.send(('format', request_id, targets, filtered, stage_seconds.drain()))
+            elif kind == 'reload':
+                loop.run_until_complete(table.load(owns))
+                conn.send(('loaded',))
+            elif kind == 'stop':
+                break
+    except Exception as e:
+        logger.exception(f"分片工作进程出错: {str(e)}", extra=fields(shard=index))
+        raise
+    finally:
+        conn.close()
+        loop.run_until_complete(engine.dispose())
+        loop.close()
+        log_listener.stop()
+
+if __name__ == '__main__':
+    # 以模块名导入，日志器名称与主进程中一致
+    from shards import run_worker
+    run_worker(*map(int, sys.argv[1:4]))
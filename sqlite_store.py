@@ -0,0 +1,53 @@
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+class SQLiteStore:
+    """保存在单独 SQLite 文件中的存储，发件箱和消息对应关系共用
+
+    连接只在一个专用线程中使用，读写都交给这个线程执行，不阻塞事件循环。
+    写入采用组提交：同一时间只有一个事务在写，期间到达的变更合并到下一个事务中一起提交。
+    子类实现 _setup() 建表，_pending() 判断是否还有未提交的变更，_commit() 取出一批变更写入。
+    """
+    def __init__(self, path, name):
+        self.path = path
+        self.conn = None
+        self._flush_task = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+
+    def open(self):
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self._setup()
+        self.conn.commit()
+
+    def _setup(self):
+        raise NotImplementedError
+
+    async def _run(self, func, *args):
+        """在连接所在的线程中执行"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _pending(self):
+        raise NotImplementedError
+
+    async def _commit(self):
+        raise NotImplementedError
+
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        while self._pending():
+            await self._commit()
+
+    async def close(self):
+        if self._flush_task is not None:
+            await self._flush_task
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        self._executor.shutdown(wait=True)